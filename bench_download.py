@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# End-to-end benchmark of the download path, run against synthetic Dubois
+# domains in a local SimpleDB stand-in instead of AWS:
+#   SDB select pages -> make_df_from_sdb -> df_force_numerics -> DataframeSmartMerger
+# For each stage it reports wall time, item throughput, per-request latency
+# and peak traced memory.
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+
+import sdb_standin
+import synthetic_dubois
+import dubois
+import sdb_utils
+import sdb_scheduler
+
+# tracing that was already on (instrumentation's, say) is left running
+def measure(stage, func, num_items=None):
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.time()
+    result = func()
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    if not was_tracing:
+        tracemalloc.stop()
+    row = {
+        'stage': stage,
+        'seconds': seconds,
+        'peak_mb': peak / 1e6,
+    }
+    if num_items is not None:
+        row['items'] = num_items
+        row['items_per_sec'] = num_items / seconds if seconds else None
+    return result, row
+
+def bench_size(num_answers, args):
+    date_start, date_end = synthetic_dubois.default_window(args.days)
+    conn = sdb_standin.StandinConnection(page_size=args.page_size, latency=args.latency,
+                                         throttle_rate=args.throttle, seed=0)
+    # a fresh scheduler, so that each size starts from the same concurrency limit
+    sdb_scheduler.default_scheduler = sdb_scheduler.RequestScheduler(seed=0)
+    sizes = synthetic_dubois.install_standin_domains(conn, dubois._dubois_domains,
+                                                     num_answers, date_start, date_end)
+    answers = [dd for dd in dubois._dubois_domains if dd.shortname == 'answers'][0]
+    domain = conn.get_domain(answers.name)
+    rows = list()
+
+    def select_pages():
+        page_times = list()
+        pages = list()
+        last = time.time()
+        for page in sdb_utils.iter_dtrange_from_domain(
+                domain, datetime_col=answers.main_datetime_column,
+                date_start=date_start, date_end=date_end,
+                partitions=args.partitions, conn_factory=lambda: conn):
+            now = time.time()
+            page_times.append(now - last)
+            last = now
+            pages.append(page)
+        return pages, page_times
+    requests_before = conn.num_requests
+    (pages, page_times), row = measure('select_pages', select_pages, sizes['answers'])
+    page_times.sort()
+    row['requests'] = conn.num_requests - requests_before
+    row['scheduler'] = sdb_scheduler.default_scheduler.stats()
+    row['pages'] = len(pages)
+    row['page_latency_median'] = page_times[len(page_times) // 2] if page_times else None
+    row['page_latency_p95'] = page_times[int(len(page_times) * 0.95)] if page_times else None
+    rows.append(row)
+
+    df, row = measure('make_df_from_sdb',
+                      lambda: sdb_utils.make_df_from_sdb(pages, force_numerics=False),
+                      sizes['answers'])
+    rows.append(row)
+    del pages
+    failures, row = measure('df_force_numerics',
+                            lambda: sdb_utils.df_force_numerics(df, answers.schema),
+                            sizes['answers'])
+    rows.append(row)
+    del df
+
+    df_merger, row = measure(
+        'download_recent_domain_data',
+        lambda: dubois.download_recent_domain_data(
+            conn, date_start=date_start, date_end=date_end, lcl_dir=None,
+            max_workers=args.workers, conn_factory=lambda: conn,
+            partitions=args.partitions, encode_keys=args.encode_keys),
+        sum(sizes.values()))
+    rows.append(row)
+
+    def merge_chain():
+        merged = df_merger.smart_merge('answers', 'challenges')
+        return df_merger.smart_merge(merged, 'games')
+    merged, row = measure('smart_merge answers challenges games', merge_chain,
+                          sizes['answers'])
+    rows.append(row)
+
+    for row in rows:
+        row['num_answers'] = num_answers
+    return rows
+
+def print_rows(rows):
+    print('{:>10} {:<40} {:>9} {:>12} {:>9}'.format(
+        'answers', 'stage', 'seconds', 'items/sec', 'peak MB'))
+    for row in rows:
+        print('{:>10} {:<40} {:>9.3f} {:>12} {:>9.1f}'.format(
+            row['num_answers'], row['stage'], row['seconds'],
+            '{:.0f}'.format(row['items_per_sec']) if row.get('items_per_sec') else '',
+            row['peak_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the SDB download path offline.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='numbers of answers to generate (the other domains scale with it)')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--page-size', type=int, default=2500)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every SDB request')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of SDB requests that are throttled')
+    parser.add_argument('--partitions', default=1,
+                        help="number of time-range partitions per domain, or 'auto'")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--encode-keys', action='store_true',
+                        help='encode keys as shared categoricals before merging')
+    parser.add_argument('--json', help='also write the results to this file as JSON')
+    args = parser.parse_args()
+    if args.partitions != 'auto':
+        args.partitions = int(args.partitions)
+
+    all_rows = list()
+    for num_answers in args.rows:
+        all_rows += bench_size(num_answers, args)
+    print_rows(all_rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_rows, f, indent=2)
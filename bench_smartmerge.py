@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Microbenchmarks for smartmerge and sdb_utils type coercion, on synthetic
+# Dubois frames (see synthetic_dubois) rather than anything from SDB:
+#   make_dataframe_from_records_with_dates, df_force_numerics,
+#   compact_dtypes, registering the known merges, smart_merge chains and
+#   merge_chain (on plain, key-encoded and compacted frames).
+# Each result is appended to bench_results/smartmerge.jsonl along with the
+# git commit it was measured at, and printed next to the most recent
+# result from a different commit, so changes can be compared commit to commit.
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+import datetime as dt
+
+import pandas as pd
+
+import synthetic_dubois
+import dubois
+import sdb_utils
+
+RESULTS_DIR = 'bench_results'
+RESULTS_FILE = RESULTS_DIR + os.sep + 'smartmerge.jsonl'
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+                                stderr=subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+# best of repeats, since anything slower was slowed by something else.
+# setup() runs before each repeat and isn't timed; its result goes to func.
+def best_time(func, repeats, setup=None):
+    best = None
+    for _ in range(repeats):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def make_string_frames(num_answers):
+    date_start, date_end = synthetic_dubois.default_window()
+    sizes = synthetic_dubois.domain_sizes(num_answers)
+    return dict((dd.shortname, synthetic_dubois.make_domain_frame(dd.shortname, sizes,
+                                                                  date_start, date_end))
+                for dd in dubois._dubois_domains)
+
+def typed_frames(string_frames):
+    frames = dict()
+    for dd in dubois._dubois_domains:
+        DF = string_frames[dd.shortname].copy()
+        sdb_utils.df_force_numerics(DF, dd.schema)
+        frames[dd.shortname] = DF
+    return frames
+
+def bench_size(num_answers, args):
+    print('building synthetic frames for {} answers'.format(num_answers))
+    string_frames = make_string_frames(num_answers)
+    answers = dubois._domains_by_shortname['answers']
+    results = list()
+    def add(benchmark, rows, seconds):
+        results.append({'benchmark': benchmark, 'rows': rows, 'num_answers': num_answers,
+                        'seconds': seconds})
+        print('{:>10} {:<62} {:>9.4f}'.format(num_answers, benchmark, seconds))
+
+    if num_answers <= args.max_record_rows:
+        records = string_frames['answers'].reset_index().to_dict('records')
+        add('make_dataframe_from_records_with_dates answers', len(records), best_time(
+            lambda _: sdb_utils.make_dataframe_from_records_with_dates(records,
+                                                                       schema=answers.schema),
+            args.repeats))
+        del records
+    add('df_force_numerics answers', num_answers, best_time(
+        lambda DF: sdb_utils.df_force_numerics(DF, answers.schema), args.repeats,
+        setup=lambda: string_frames['answers'].copy()))
+
+    frames = typed_frames(string_frames)
+    del string_frames
+    add('compact_dtypes answers', num_answers, best_time(
+        lambda DF: sdb_utils.compact_dtypes(DF), args.repeats,
+        setup=lambda: frames['answers'].copy()))
+    ddomains = dubois._dubois_domains
+    dfs = [frames[dd.shortname] for dd in ddomains]
+    compact_dfs = [DF.copy() for DF in dfs]
+    for dd, DF in zip(ddomains, compact_dfs):
+        bytes_before, bytes_after = sdb_utils.compact_dtypes(DF)
+        print('{:>10} {} compacted from {:.1f} MB to {:.1f} MB'.format(
+            num_answers, dd.shortname, bytes_before / 1e6, bytes_after / 1e6))
+    add('build merger and register known merges', len(dubois._known_merges), best_time(
+        lambda _: dubois._build_merger(ddomains, dfs), args.repeats))
+    for label, merge_dfs, encode_keys in (('', dfs, False),
+                                          (' (encoded keys)', dfs, True),
+                                          (' (compact dtypes)', compact_dfs, False)):
+        def new_merger():
+            return dubois._build_merger(ddomains, merge_dfs, encode_keys=encode_keys)
+        add('smart_merge answers challenges games' + label, num_answers, best_time(
+            lambda m: m.smart_merge(m.smart_merge('answers', 'challenges'), 'games'),
+            args.repeats, setup=new_merger))
+        add('smart_merge games mathletes devices' + label, len(frames['games']), best_time(
+            lambda m: m.smart_merge(m.smart_merge('games', 'mathletes'), 'devices'),
+            args.repeats, setup=new_merger))
+        add('merge_chain answers challenges games mathletes' + label, num_answers, best_time(
+            lambda m: m.merge_chain(['answers', 'challenges', 'games', 'mathletes']),
+            args.repeats, setup=new_merger))
+    return results
+
+def read_results(path):
+    if not os.path.exists(path):
+        return list()
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# the most recent result for each (benchmark, num_answers) from another commit
+def previous_results(old_results, commit):
+    previous = dict()
+    for result in old_results:
+        if result['commit'] != commit:
+            previous[(result['benchmark'], result['num_answers'])] = result
+    return previous
+
+def print_comparison(results, previous):
+    print('')
+    print('{:>10} {:<62} {:>9} {:>9} {:>8} {:>8}'.format(
+        'answers', 'benchmark', 'seconds', 'before', 'ratio', 'commit'))
+    for result in results:
+        before = previous.get((result['benchmark'], result['num_answers']))
+        if before:
+            print('{:>10} {:<62} {:>9.4f} {:>9.4f} {:>8.2f} {:>8}'.format(
+                result['num_answers'], result['benchmark'], result['seconds'],
+                before['seconds'], result['seconds'] / before['seconds'], before['commit']))
+        else:
+            print('{:>10} {:<62} {:>9.4f}'.format(
+                result['num_answers'], result['benchmark'], result['seconds']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark smart merges and type coercion '
+                                     'on synthetic Dubois frames.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='numbers of answers to generate (up to 10000000); '
+                        'the other domains scale with it')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-record-rows', type=int, default=1000000,
+                        help='skip the records benchmark above this many answers, '
+                        'since the records alone take a lot of memory')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='file that results are appended to')
+    parser.add_argument('--no-save', action='store_true', help="don't append the results")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    previous = previous_results(read_results(args.results), commit)
+    measured_at = dt.datetime.now().replace(microsecond=0).isoformat()
+    results = list()
+    for num_answers in args.rows:
+        results += bench_size(num_answers, args)
+    for result in results:
+        result.update({'commit': commit, 'dirty': dirty, 'measured_at': measured_at,
+                       'python': platform.python_version(), 'pandas': pd.__version__})
+    print_comparison(results, previous)
+    if not args.no_save:
+        results_dir = os.path.dirname(args.results)
+        if results_dir and not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        with open(args.results, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print('Appended {} results to {}'.format(len(results), args.results))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Measures how long the interactive scripts take to come up: the time from
+# launching each one until its first date prompt is shown, next to how
+# long the heavy imports they put off (see startup) take on their own.
+# Each result is appended to bench_results/startup.jsonl along with the git
+# commit it was measured at, and printed next to the most recent result
+# from a different commit.
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+import datetime as dt
+
+from bench_smartmerge import git_commit, read_results
+
+RESULTS_DIR = 'bench_results'
+RESULTS_FILE = RESULTS_DIR + os.sep + 'startup.jsonl'
+
+PROMPT = b'DATE >>> '
+SCRIPTS = ['simple_queries.py', 'download_data.py']
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# seconds from launching script until it prints the date prompt. stdin is
+# then closed, which the script takes as Ctrl-D.
+def time_to_prompt(script):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-u', script], cwd=here,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = b''
+    while PROMPT not in output:
+        chunk = proc.stdout.read1(4096)
+        if not chunk:
+            proc.wait()
+            raise RuntimeError(script + ' exited before prompting:\n' +
+                               output.decode(errors='replace'))
+        output += chunk
+    seconds = time.perf_counter() - start
+    proc.stdin.close()
+    proc.stdout.read()
+    proc.wait()
+    return seconds
+
+# seconds for a whole python process that runs code
+def time_process(code):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', code], cwd=here)
+    return time.perf_counter() - start
+
+def best_of(func, repeats):
+    return min(func() for _ in range(repeats))
+
+def run_benchmarks(repeats):
+    results = list()
+    def add(benchmark, seconds):
+        results.append({'benchmark': benchmark, 'seconds': seconds})
+        print('{:<40} {:>9.4f}'.format(benchmark, seconds))
+    add('python startup', best_of(lambda: time_process('pass'), repeats))
+    add('import pandas', best_of(lambda: time_process('import pandas'), repeats))
+    add('import dubois', best_of(lambda: time_process('import dubois'), repeats))
+    for script in SCRIPTS:
+        add(script + ' to first prompt', best_of(lambda: time_to_prompt(script), repeats))
+    return results
+
+def print_comparison(results, old_results, commit):
+    previous = dict()
+    for result in old_results:
+        if result['commit'] != commit:
+            previous[result['benchmark']] = result
+    print('')
+    print('{:<40} {:>9} {:>9} {:>8} {:>8}'.format('benchmark', 'seconds', 'before',
+                                                  'ratio', 'commit'))
+    for result in results:
+        before = previous.get(result['benchmark'])
+        if before:
+            print('{:<40} {:>9.4f} {:>9.4f} {:>8.2f} {:>8}'.format(
+                result['benchmark'], result['seconds'], before['seconds'],
+                result['seconds'] / before['seconds'], before['commit']))
+        else:
+            print('{:<40} {:>9.4f}'.format(result['benchmark'], result['seconds']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how quickly the interactive '
+                                     'scripts show their first prompt.')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='file that results are appended to')
+    parser.add_argument('--no-save', action='store_true', help="don't append the results")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    old_results = read_results(args.results)
+    measured_at = dt.datetime.now().replace(microsecond=0).isoformat()
+    results = run_benchmarks(args.repeats)
+    for result in results:
+        result.update({'commit': commit, 'dirty': dirty, 'measured_at': measured_at,
+                       'python': platform.python_version()})
+    print_comparison(results, old_results, commit)
+    if not args.no_save:
+        results_dir = os.path.dirname(args.results)
+        if results_dir and not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        with open(args.results, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print('Appended {} results to {}'.format(len(results), args.results))
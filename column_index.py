@@ -0,0 +1,158 @@
+# Sorted indexes over the columns of a dataframe, built the first time a
+# column is filtered or sorted on and reused after that. Range filters are
+# answered by binary search in the sorted values, and sorts by the cached
+# order, instead of scanning or sorting the column again every time.
+#
+# Rows are referred to by position in the frame. Wherever positions are
+# passed in, None means all of the frame's rows, in frame order.
+import numpy as np
+import pandas as pd
+
+# comparison ops that can be answered from the sorted values
+_range_ops = ['<', '<=', '>', '>=', '==', '=']
+
+class _SortedColumn:
+    def __init__(self, series):
+        values = series.reset_index(drop=True)
+        # a stable sort, so that equal values stay in frame order
+        self.order = values.sort_values(kind='mergesort', na_position='last').index.values
+        self.num_valid = int(values.notnull().sum())
+        self.sorted_values = np.asarray(values)[self.order[:self.num_valid]]
+        # equal values share a rank, and missing values rank after everything
+        rank_in_order = np.zeros(len(values), dtype=np.int64)
+        if self.num_valid > 1:
+            distinct = self.sorted_values[1:] != self.sorted_values[:-1]
+            rank_in_order[1:self.num_valid] = np.cumsum(distinct)
+        num_distinct = rank_in_order[self.num_valid - 1] + 1 if self.num_valid else 0
+        rank_in_order[self.num_valid:] = num_distinct
+        self.rank = np.empty(len(values), dtype=np.int64)
+        self.rank[self.order] = rank_in_order
+        self.num_distinct = num_distinct
+        self.full_sorts = dict() # ascending -> positions of the whole frame, sorted
+
+    # the sort key for each row. ties keep their relative order when
+    # sorted stably, which is what sort_values(kind='mergesort') does too.
+    def sort_key(self, ascending):
+        if ascending:
+            return self.rank
+        return np.where(self.rank < self.num_distinct,
+                        self.num_distinct - 1 - self.rank, self.num_distinct)
+
+    def matching(self, op, value):
+        left = np.searchsorted(self.sorted_values, value, side='left')
+        right = np.searchsorted(self.sorted_values, value, side='right')
+        if op == '<':
+            return self.order[:left]
+        elif op == '<=':
+            return self.order[:right]
+        elif op == '>':
+            return self.order[right:self.num_valid]
+        elif op == '>=':
+            return self.order[left:self.num_valid]
+        return self.order[left:right]
+
+# converts a value typed by the user to something comparable with the
+# column's sorted values, or returns None if the column can't be indexed.
+def _comparable_value(series, value):
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return None
+    if dtype.kind in 'iuf' and isinstance(dtype, np.dtype):
+        return float(value)
+    if dtype.kind == 'M' and isinstance(dtype, np.dtype):
+        return np.datetime64(pd.Timestamp(value))
+    if dtype.kind == 'O' or pd.api.types.is_string_dtype(dtype):
+        return value
+    return None
+
+# what a column's index was built from: its dtype and the array holding
+# its values, which is replaced when the column is assigned (as
+# sdb_utils.compact_dtypes does). the array is kept along with its
+# address, so that the memory can't be reused by a new column while the
+# index is cached.
+def _column_source(series):
+    if isinstance(series.dtype, np.dtype):
+        values = series.to_numpy(copy=False)
+        return series.dtype, values, (values.__array_interface__['data'][0], values.strides)
+    values = series.array
+    return series.dtype, values, id(values)
+
+def _same_source(source, other):
+    return source[0] == other[0] and source[2] == other[2]
+
+# One of these belongs to a single frame (see
+# DataframeSmartMerger.get_column_index); the frame is passed in to every
+# call rather than kept, so the index doesn't keep the frame alive.
+# Indexes are thrown away when the frame's shape changes, when a column's
+# dtype or values array changes, or by invalidate.
+class ColumnIndexManager:
+    def __init__(self):
+        self._shape = None
+        self._columns = dict() # column name -> _SortedColumn, or None if it can't be sorted
+        self._sources = dict() # column name -> _column_source it was built from
+
+    def invalidate(self, column=None):
+        if column is None:
+            self._columns = dict()
+            self._sources = dict()
+        else:
+            self._columns.pop(column, None)
+            self._sources.pop(column, None)
+
+    def _sorted_column(self, df, column):
+        if df.shape != self._shape:
+            self.invalidate()
+            self._shape = df.shape
+        source = _column_source(df[column])
+        if column in self._columns and not _same_source(self._sources[column], source):
+            self.invalidate(column)
+        if column not in self._columns:
+            self._sources[column] = source
+            try:
+                self._columns[column] = _SortedColumn(df[column])
+            except TypeError:
+                # mixed types (like multi-valued attributes) have no order
+                self._columns[column] = None
+        return self._columns[column]
+
+    # positions of the rows among positions where the column compares
+    # true against value, in the order they are in positions. returns
+    # None if the index can't answer this, and the caller should filter
+    # the usual way.
+    def filter_positions(self, df, column, op, value, positions=None):
+        if op not in _range_ops:
+            return None
+        try:
+            value = _comparable_value(df[column], value)
+        except (ValueError, TypeError):
+            return None
+        if value is None:
+            return None
+        sorted_column = self._sorted_column(df, column)
+        if sorted_column is None:
+            return None
+        try:
+            matching = sorted_column.matching(op, value)
+        except TypeError:
+            return None
+        if positions is None:
+            return np.sort(matching)
+        mask = np.zeros(len(df), dtype=bool)
+        mask[matching] = True
+        return positions[mask[positions]]
+
+    # positions sorted by the column, stably, with missing values last.
+    # returns None if the column can't be sorted this way.
+    def sorted_positions(self, df, column, ascending=True, positions=None):
+        sorted_column = self._sorted_column(df, column)
+        if sorted_column is None:
+            return None
+        if positions is None:
+            if ascending:
+                return sorted_column.order
+            if ascending not in sorted_column.full_sorts:
+                sorted_column.full_sorts[ascending] = np.argsort(
+                    sorted_column.sort_key(ascending), kind='stable')
+            return sorted_column.full_sorts[ascending]
+        key = sorted_column.sort_key(ascending)[positions]
+        return positions[np.argsort(key, kind='stable')]
@@ -29,6 +29,14 @@ def today():
 def now():
     return dt.datetime.now()
 
+# A date argument may also be given as 'today', 'yesterday' or 'now', which
+# is resolved when the date is used. Defaults like date_start='yesterday'
+# then mean yesterday as of the call, not as of when the module was imported.
+def resolve_date(date):
+    if isinstance(date, str):
+        return {'today': today, 'yesterday': yesterday, 'now': now}[date]()
+    return date
+
 rangefuncs = {
     'today':today,
     'yesterday':yesterday,
@@ -38,11 +46,14 @@ rangefuncs = {
     'months':months_ago,
 }
 
-def ask_for_date():
+# any of extra_choices typed on its own is returned as-is instead of a date
+def ask_for_date(extra_choices=()):
     while True:
-        ranges_completer = Completer(rangefuncs.keys())
+        ranges_completer = Completer(list(rangefuncs.keys()) + list(extra_choices))
         readline.set_completer(ranges_completer.complete)
         rgnf = input('DATE >>> ')
+        if rgnf in extra_choices:
+            return rgnf
         all_args = rgnf.split(' ')
 
         func_args = list()
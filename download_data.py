@@ -1,13 +1,32 @@
 #!/usr/bin/env python
+import startup
 import sys, re, os
-import pandas as pd
+import argparse
 
-if __name__ == '__main__':
+# pandas and dubois (and boto through it) are slow to import, so they're
+# imported in the background while the first prompt waits for the user.
+def warm_up():
+    import pandas as pd
     pd.set_option('display.max_rows', 9999)
     pd.set_option('display.width', None)
-
     import dubois
-    conn = dubois.get_admin_conn()
+    return dubois.get_admin_conn()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download DuBois Project data.')
+    parser.add_argument('--auto-columns', action='store_true',
+                        help='download only the columns used for display and merging')
+    parser.add_argument('--compact-dtypes', action='store_true',
+                        help='downcast numbers and make repetitive strings categorical '
+                        'to save memory')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='time every stage and write a JSON report here on exit')
+    args = parser.parse_args()
+    select_columns = 'auto' if args.auto_columns else None
+    import instrumentation
+    if args.profile:
+        instrumentation.enable()
+    warm = startup.Warmup(warm_up)
 
     import datetime_utils
     print('Welcome to the DuBois Project Data Explorer!')
@@ -16,16 +35,45 @@ if __name__ == '__main__':
     # start readline
     import readline
     readline.parse_and_bind('tab: complete')
+    instrumentation.record('startup', startup.seconds_since_start())
 
+    df_sm = None
+    window_start = None # date_start of the last download, if there was one
     while True:
         try:
-            # local_data = raw_input('type a dirname to use local data, or press enter to download')
-            # if local_data and os.path.exists(local_data):
-
             print('How far back should I download?')
-            start = datetime_utils.ask_for_date()
-            df_sm = dubois.download_recent_domain_data(conn, date_start=start)
-            print('Wrote that data to a CSV file. To exit, use Ctrl-D')
+            can_sync = df_sm is not None or startup.may_have_local_data(warm)
+            if can_sync:
+                print('Or type sync to fetch only what is new since the last download.')
+            start = datetime_utils.ask_for_date(
+                extra_choices=['sync'] if can_sync else [])
+            if warm is not None:
+                conn = warm.result()
+                instrumentation.record('warmup', warm.seconds)
+                warm = None
+                import dubois
+            if start == 'sync' and df_sm is None and not dubois.has_local_domain_data():
+                print('There is no complete local copy of the data to sync.')
+                continue
+            if start == 'sync':
+                if df_sm is None:
+                    df_sm = dubois.load_local_domain_data()
+                df_sm = dubois.sync_domain_data(
+                    conn, df_sm, max_workers=dubois.DEFAULT_DOWNLOAD_WORKERS,
+                    partitions=dubois.DEFAULT_DOWNLOAD_PARTITIONS,
+                    select_columns=select_columns, compact=args.compact_dtypes,
+                    window_start=window_start)
+            else:
+                window_start = start
+                df_sm = dubois.download_recent_domain_data(
+                    conn, date_start=start, max_workers=dubois.DEFAULT_DOWNLOAD_WORKERS,
+                    partitions=dubois.DEFAULT_DOWNLOAD_PARTITIONS,
+                    select_columns=select_columns, compact=args.compact_dtypes)
+            print('Saved that data to local_data. To exit, use Ctrl-D')
         except (KeyboardInterrupt, EOFError) as e:
             print('\nLeaving the DuBois Project Data Explorer.')
             break
+    if args.profile:
+        instrumentation.print_summary()
+        instrumentation.dump(args.profile)
+        print('Wrote profile to ' + args.profile)
@@ -0,0 +1,126 @@
+# Records how long each stage of the download/merge/display pipeline
+# takes, per domain, along with whatever it counted (pages, items, rows,
+# bytes) and the peak memory traced while it ran.
+#
+# Nothing is recorded until enable() is called, so the stages cost next
+# to nothing otherwise. Memory is traced with tracemalloc, which slows
+# everything down noticeably; stages that run at the same time in
+# different threads see each other's allocations in their peaks.
+import sys
+import time
+import json
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+enabled = False
+_trace_memory = False
+_records = list()
+_open_records = list() # records of stages that haven't finished yet
+_lock = threading.Lock()
+_started = None
+
+def enable(trace_memory=True):
+    global enabled, _trace_memory, _started
+    enabled = True
+    _trace_memory = trace_memory
+    _started = time.time()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global enabled
+    enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def clear():
+    with _lock:
+        del _records[:]
+
+# every open stage has seen at least the peak since the last reset
+def _fold_peak():
+    peak = tracemalloc.get_traced_memory()[1]
+    for rec in _open_records:
+        rec['_peak'] = max(rec['_peak'], peak)
+    tracemalloc.reset_peak()
+
+def _new_record(name, domain, counts):
+    rec = {'stage': name, 'domain': domain, 'start': time.time() - _started}
+    rec.update(counts)
+    return rec
+
+# Times the body of the with statement as one run of the named stage.
+# The record is yielded so that counts can be added to it as they become
+# known, e.g. rec['items'] = len(df).
+@contextmanager
+def stage(name, domain=None, **counts):
+    if not enabled:
+        yield dict()
+        return
+    rec = _new_record(name, domain, counts)
+    if _trace_memory:
+        with _lock:
+            _fold_peak()
+            rec['_peak'] = tracemalloc.get_traced_memory()[0]
+            _open_records.append(rec)
+    start = time.time()
+    try:
+        yield rec
+    finally:
+        rec['seconds'] = time.time() - start
+        with _lock:
+            if _trace_memory:
+                _fold_peak()
+                _open_records.remove(rec)
+                rec['peak_mb'] = rec.pop('_peak') / 1e6
+            _records.append(rec)
+
+# for stages that are timed by the caller, like work spread over a loop
+def record(name, seconds, domain=None, **counts):
+    if not enabled:
+        return
+    rec = _new_record(name, domain, counts)
+    rec['start'] -= seconds
+    rec['seconds'] = seconds
+    with _lock:
+        _records.append(rec)
+
+def records():
+    with _lock:
+        return list(_records)
+
+# totals per (stage, domain), in the order the stages first ran
+def summarize():
+    summary = list()
+    by_key = dict()
+    for rec in records():
+        key = (rec['stage'], rec['domain'])
+        if key not in by_key:
+            by_key[key] = {'stage': rec['stage'], 'domain': rec['domain'],
+                           'runs': 0, 'seconds': 0.0}
+            summary.append(by_key[key])
+        total = by_key[key]
+        total['runs'] += 1
+        for field, value in rec.items():
+            if field in ('stage', 'domain', 'start', 'runs'):
+                continue
+            if field == 'peak_mb':
+                total[field] = max(total.get(field, 0), value)
+            elif isinstance(value, (int, float)):
+                total[field] = total.get(field, 0) + value
+    return summary
+
+def print_summary(out=sys.stdout):
+    out.write('{:<18} {:<34} {:>5} {:>9} {:>6} {:>9} {:>11} {:>8}\n'.format(
+        'stage', 'domain', 'runs', 'seconds', 'pages', 'items', 'bytes', 'peak MB'))
+    for total in summarize():
+        out.write('{:<18} {:<34} {:>5} {:>9.3f} {:>6} {:>9} {:>11} {:>8}\n'.format(
+            total['stage'], total['domain'] or '', total['runs'], total['seconds'],
+            total.get('pages', ''), total.get('items', total.get('rows', '')),
+            total.get('bytes', ''),
+            '{:.1f}'.format(total['peak_mb']) if 'peak_mb' in total else ''))
+
+def dump(path):
+    with open(path, 'w') as f:
+        json.dump({'records': records(), 'summary': summarize()}, f, indent=2, default=str)
@@ -0,0 +1,142 @@
+# a typed, columnar local copy of downloaded domains, so that reopening
+# data doesn't require re-parsing or re-inferring column types.
+# Parquet is used when pyarrow is installed. Otherwise (or for frames
+# pyarrow can't represent, like multi-valued SDB attributes) we fall back
+# to pandas' pickle format, which also keeps dtypes but isn't columnar.
+import os
+import json
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    STORE_FORMAT = 'parquet'
+except ImportError:
+    STORE_FORMAT = 'pickle'
+
+_extensions = {
+    'parquet': '.parquet',
+    'pickle': '.pkl',
+}
+
+def domain_path(lcl_dir, domain_name, fmt=STORE_FORMAT):
+    return lcl_dir + os.sep + domain_name + _extensions[fmt]
+
+def _existing_paths(lcl_dir, domain_name):
+    paths = [domain_path(lcl_dir, domain_name, fmt) for fmt in _extensions]
+    return [path for path in paths if os.path.exists(path)]
+
+def has_domain_df(lcl_dir, domain_name):
+    return len(_existing_paths(lcl_dir, domain_name)) > 0
+
+# written aside and then moved into place, so that a failed or
+# interrupted write leaves the previous copy as it was, and a half-written
+# file is never read back. returns the path written
+def write_domain_df(DF, lcl_dir, domain_name):
+    if not os.path.exists(lcl_dir):
+        os.makedirs(lcl_dir)
+    fmt = STORE_FORMAT
+    if fmt == 'parquet':
+        tmp_path = domain_path(lcl_dir, domain_name, 'parquet') + '.tmp'
+        try:
+            DF.to_parquet(tmp_path)
+        except Exception as e:
+            print('could not store {} as parquet ({}); using pickle'.format(domain_name, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            fmt = 'pickle'
+    if fmt == 'pickle':
+        tmp_path = domain_path(lcl_dir, domain_name, 'pickle') + '.tmp'
+        try:
+            DF.to_pickle(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    path = domain_path(lcl_dir, domain_name, fmt)
+    os.replace(tmp_path, path)
+    # only now that the new copy is in place are copies in other formats
+    # removed, so that a stale one is never read back
+    for other_path in _existing_paths(lcl_dir, domain_name):
+        if other_path != path:
+            os.remove(other_path)
+    return path
+
+def read_domain_df(lcl_dir, domain_name):
+    paths = _existing_paths(lcl_dir, domain_name)
+    if not paths:
+        raise IOError('no local copy of ' + domain_name + ' in ' + lcl_dir)
+    path = max(paths, key=os.path.getmtime)
+    if path.endswith(_extensions['parquet']):
+        # mapped rather than read in, so only the pages actually used are loaded
+        return pd.read_parquet(path, memory_map=True)
+    return pd.read_pickle(path)
+
+# A domain with a datetime column can also be kept one file per day of that
+# column, in a directory of its own, along with a manifest of the days that
+# are complete: days that had already ended when they were downloaded, so
+# that nothing more is expected for them. A date window can then be read
+# from the days it covers, and only the rest of it downloaded.
+DAY_MANIFEST = 'manifest.json'
+
+def days_dir(lcl_dir, domain_name):
+    return lcl_dir + os.sep + domain_name + '.days'
+
+def _day_manifest_path(lcl_dir, domain_name):
+    return days_dir(lcl_dir, domain_name) + os.sep + DAY_MANIFEST
+
+# {day (a datetime.date): number of rows} for the complete days stored
+def read_day_manifest(lcl_dir, domain_name):
+    path = _day_manifest_path(lcl_dir, domain_name)
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        days = json.load(f)['days']
+    return dict((dt.date.fromisoformat(day), rows) for day, rows in days.items())
+
+def _write_day_manifest(lcl_dir, domain_name, manifest):
+    path = _day_manifest_path(lcl_dir, domain_name)
+    days = dict((day.isoformat(), rows) for day, rows in sorted(manifest.items()))
+    # written aside and then moved into place, so an interrupted write
+    # can't leave a manifest naming days that weren't stored
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'days': days}, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+# stores the rows of DF that fall on each of days (by the date of
+# datetime_col), and marks those days complete. days without any rows are
+# only recorded in the manifest, as are all of them if DF is empty (an
+# empty download has no columns at all).
+def write_days(DF, lcl_dir, domain_name, datetime_col, days):
+    if not days:
+        return
+    directory = days_dir(lcl_dir, domain_name)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    if datetime_col in DF:
+        row_days = DF[datetime_col].values.astype('datetime64[D]')
+    else:
+        row_days = np.array([], dtype='datetime64[D]')
+    # rows sorted by day once, so each day is a slice instead of a scan
+    order = np.argsort(row_days, kind='stable')
+    sorted_days = row_days[order]
+    manifest = read_day_manifest(lcl_dir, domain_name)
+    for day in days:
+        lo, hi = np.searchsorted(sorted_days, [np.datetime64(day), np.datetime64(day) + 1])
+        if hi > lo:
+            write_domain_df(DF.iloc[order[lo:hi]], directory, day.isoformat())
+        else:
+            for path in _existing_paths(directory, day.isoformat()):
+                os.remove(path)
+        manifest[day] = int(hi - lo)
+    _write_day_manifest(lcl_dir, domain_name, manifest)
+
+# the stored rows of days, all in one frame, or None if there are none
+def read_days(lcl_dir, domain_name, days):
+    directory = days_dir(lcl_dir, domain_name)
+    manifest = read_day_manifest(lcl_dir, domain_name)
+    frames = [read_domain_df(directory, day.isoformat()) for day in days if manifest.get(day)]
+    if not frames:
+        return None
+    return pd.concat(frames)
@@ -3,45 +3,70 @@
 import sys
 import re
 
+# how far into nested objects rsearch_obj_regex goes, and how many
+# objects it looks at in all, before giving up
+DEFAULT_MAX_DEPTH = 32
+DEFAULT_MAX_NODES = 1000000
+
 def match_string(string, regex):
-    if isinstance(regex, basestring):
+    if isinstance(regex, str):
         return re.search(regex, string)
     else:
         # assume it's a compiled regex
         return regex.match(string)
-    
-def rsearch_obj_regex(obj, regex, name, flatlist=list()):
-    if isinstance(obj, basestring):
-        flatlist.append((name, match_string(obj, regex), obj))
-    else: # either an object/dict or a number or a sequence
-        try:
-            for i, item in enumerate(iter(obj)):
-                try: # dict?
-                    rsearch_obj_regex(obj[item], regex, name + '[' + str(item) + ']', flatlist)
-                except (KeyError, IndexError) as e:
-                    # might have been a list or set, not a dict
-                    rsearch_obj_regex(item, regex, name + '[' + str(i) + ']', flatlist)
-        except TypeError: # not iterable, maybe an object?
-            try:
-                names = [nname for nname in dir(obj)]
-                names = [nname for nname in names if not nname.startswith('__')]
-                names = [nname for nname in names if not callable(getattr(obj,nname))]
-
-                results = list()
-                for rname in names:
-                    rsearch_obj_regex(obj[rname], regex, name + '.' + str(rname), flatlist)
-            except:
-                # convert to string and try again?
-                print('failed with ' + str(obj))
-                flatlist.append((name, None, None))
-        except:
-            # convert to string and try again?
-            print('failed with ' + str(obj))
-            flatlist.append((name, None, None))
-    return flatlist
 
-            
+# the (name, child) pairs to search inside obj, without building a list of them
+def _children(obj, name):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            yield name + '[' + str(key) + ']', value
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for i, item in enumerate(obj):
+            yield name + '[' + str(i) + ']', item
+    elif hasattr(obj, '__dict__'):
+        # an ordinary object's attributes, without going through dir()
+        for attr, value in vars(obj).items():
+            if not attr.startswith('__') and not callable(value):
+                yield name + '.' + attr, value
 
-            
-        
-    
+# Searches obj, and everything inside it, for strings matching regex, and
+# yields (name, match, string) for each one, where name is the path to it
+# from obj (like obj.attrs[3]). As in match_string, a regex given as a
+# string is searched for anywhere in each string (it is compiled once),
+# and a compiled regex has to match at the start of it.
+# The search is iterative, so deep nesting can't overflow the stack, and
+# each object is only looked into once, so cycles are fine. It stops going
+# deeper than max_depth, and stops altogether after max_nodes objects.
+def rsearch_obj_regex(obj, regex, name='obj', max_depth=DEFAULT_MAX_DEPTH,
+                      max_nodes=DEFAULT_MAX_NODES):
+    if isinstance(regex, str):
+        find = re.compile(regex).search
+    else:
+        find = regex.match
+    # ids of the objects already looked into. the objects are kept too, so
+    # that an id can't be reused by a new object while we're searching.
+    visited = dict()
+    # iterators over the children still to be searched, one per level
+    stack = [iter([(name, obj)])]
+    num_nodes = 0
+    while stack:
+        try:
+            child_name, child = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        num_nodes += 1
+        if num_nodes > max_nodes:
+            print('stopped searching after {} objects'.format(max_nodes))
+            return
+        if isinstance(child, str):
+            match = find(child)
+            if match:
+                yield child_name, match, child
+            continue
+        if child is None or isinstance(child, (bool, int, float, complex, bytes)):
+            continue
+        if id(child) in visited or len(stack) > max_depth:
+            continue
+        visited[id(child)] = child
+        stack.append(_children(child, child_name))
@@ -0,0 +1,190 @@
+# Materialized aggregate views ("rollups") over chains of smart frames,
+# like answers per mathlete per day, that are computed once and then kept
+# up to date from the new rows of each sync instead of being computed
+# again from a full merge.
+#
+# A view is declared as a chain of frames (merged as by
+# DataframeSmartMerger.merge_chain), the columns to group by, optionally
+# the day of a datetime column, and named aggregates. Only aggregates that
+# can be combined from partial results are allowed: count, sum, min, max,
+# and mean (kept as a sum and a count). Each view remembers which rows of
+# the chain's root frame it has folded in, by itemName, so an update only
+# merges and aggregates the rows it hasn't seen.
+#
+# Hashing every itemName of a big root frame on each update would cost
+# about as much as the merge it saves, so with a mark_column (the root's
+# main datetime column) a view works like sync does: it keeps a high water
+# mark, only looks at root rows at or after it, and only remembers the
+# itemNames of the rows at or after it.
+#
+# Rows that were already folded in and have since changed (an upsert of an
+# existing item) are not folded in again; rebuild() starts over.
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# how each kind of partial result is combined with another of its kind
+_combine_partials = {
+    'count': 'sum',
+    'sum': 'sum',
+    'min': 'min',
+    'max': 'max',
+}
+_aggregates = ['count', 'sum', 'min', 'max', 'mean']
+
+class RollupView:
+    # aggregates maps each output column to (input column, aggregate)
+    def __init__(self, name, chain, by, aggregates, day_of=None, mark_column=None):
+        for col, func in aggregates.values():
+            if func not in _aggregates:
+                raise ValueError('{} can only use the aggregates {}, not {}'.format(
+                    name, ', '.join(_aggregates), func))
+        self.name = name
+        self.chain = list(chain)
+        self.by = list(by)
+        self.aggregates = dict(aggregates)
+        self.day_of = day_of
+        self.mark_column = mark_column
+        self.rebuild()
+
+    # forgets everything folded in so far
+    def rebuild(self):
+        self._partials = None # group keys -> one column per partial result
+        # itemName -> mark_column value of the root rows folded in (only
+        # those at or after the mark, if there is a mark_column)
+        self._seen = None
+        self._mark = None
+        self._result = None
+
+    # partial results are named output__partial, and a mean is a sum and a count
+    def _partial_columns(self):
+        columns = list()
+        for out, (col, func) in self.aggregates.items():
+            for partial in (['sum', 'count'] if func == 'mean' else [func]):
+                columns.append((out + '__' + partial, col, partial))
+        return columns
+
+    def _aggregate(self, DF):
+        keys = [DF[col] for col in self.by]
+        if self.day_of is not None:
+            keys.append(DF[self.day_of].dt.floor('D').rename('day'))
+        grouped = DF.groupby(keys, observed=True, sort=False)
+        partials = dict()
+        for partial_col, col, partial in self._partial_columns():
+            if partial == 'sum' and not pd.api.types.is_numeric_dtype(DF[col]):
+                raise TypeError('{} sums {}, which is not numeric'.format(self.name, col))
+            partials[partial_col] = grouped[col].agg(partial)
+        return pd.DataFrame(partials)
+
+    def _fold(self, partials):
+        if self._partials is None or len(self._partials) == 0:
+            self._partials = partials
+            return
+        both = pd.concat([self._partials, partials])
+        grouped = both.groupby(level=list(range(both.index.nlevels)), sort=False)
+        self._partials = grouped.agg(dict((partial_col, _combine_partials[partial])
+                                          for partial_col, col, partial
+                                          in self._partial_columns()))
+
+    # positions of the root rows that may not have been folded in yet
+    def _candidate_positions(self, root_df):
+        if self.mark_column is None or self._mark is None:
+            return np.arange(len(root_df))
+        # missing times aren't before the mark, so those rows are always looked at
+        return np.flatnonzero(~(root_df[self.mark_column] < self._mark).values)
+
+    # folds in the rows of the chain's root frame that haven't been seen.
+    # root rows that don't match in every join of the chain are left unseen,
+    # so that they are counted once the rows they refer to arrive.
+    # returns the number of rows folded in.
+    def update(self, merger):
+        root = merger.plan_merge_chain(self.chain)[0]
+        root_df = merger[root]
+        candidates = self._candidate_positions(root_df)
+        if self._seen is None:
+            new_positions = candidates
+        else:
+            new_positions = candidates[~root_df.index.take(candidates).isin(self._seen.index)]
+        if len(new_positions) == 0:
+            return 0
+        with instrumentation.stage('rollup', domain=self.name) as rec:
+            merged = merger.merge_chain_rows(self.chain, new_positions)
+            self._fold(self._aggregate(merged))
+            if self.mark_column is None:
+                seen = pd.Series(True, index=merged.index)
+            else:
+                seen = merged[self.mark_column]
+            self._seen = seen if self._seen is None else pd.concat([self._seen, seen])
+            if self.mark_column is not None:
+                self._advance_mark(root_df, root_df.index.take(new_positions).difference(merged.index))
+            self._result = None
+            rec['rows'] = len(merged)
+        return len(merged)
+
+    # the mark moves up to the newest root row, but not past any row that
+    # couldn't be folded in yet. seen rows from before it are forgotten.
+    def _advance_mark(self, root_df, unmatched):
+        times = root_df[self.mark_column]
+        mark = times.max()
+        if len(unmatched):
+            mark = min(mark, times.loc[unmatched].min())
+        if pd.isnull(mark):
+            return
+        self._mark = mark
+        self._seen = self._seen[~(self._seen < mark).values]
+
+    # the view, one row per group
+    def result(self):
+        if self._result is not None:
+            return self._result
+        if self._partials is None:
+            return pd.DataFrame(columns=list(self.aggregates))
+        columns = dict()
+        for out, (col, func) in self.aggregates.items():
+            if func == 'mean':
+                columns[out] = (self._partials[out + '__sum'] /
+                                self._partials[out + '__count'].replace(0, np.nan))
+            else:
+                columns[out] = self._partials[out + '__' + func]
+        self._result = pd.DataFrame(columns).sort_index()
+        return self._result
+
+# Keeps a set of views up to date with the frames of a merger. Views are
+# only updated when they're asked for, so nothing is merged for a view
+# that isn't used, and lazily loaded frames stay unloaded until then.
+class RollupManager:
+    def __init__(self, views=()):
+        self._views = dict()
+        self._merger = None
+        self._stale = set()
+        for view in views:
+            self.add_view(view)
+
+    def add_view(self, view):
+        self._views[view.name] = view
+        self._stale.add(view.name)
+
+    def view_names(self):
+        return list(self._views.keys())
+
+    # with incremental, the merger holds the frames of the last one plus
+    # newly synced rows, so the views only fold in the new rows. otherwise
+    # (a new download, say) they're computed from scratch when next used.
+    def set_merger(self, merger, incremental=True):
+        self._merger = merger
+        for view in self._views.values():
+            if not incremental:
+                view.rebuild()
+        self._stale = set(self._views.keys())
+
+    def get(self, name):
+        view = self._views[name]
+        if name in self._stale:
+            if self._merger is None:
+                raise ValueError('no data to compute ' + name + ' from yet')
+            num_rows = view.update(self._merger)
+            if num_rows:
+                print('{}: folded in {} new rows'.format(name, num_rows))
+            self._stale.discard(name)
+        return view.result()
@@ -0,0 +1,122 @@
+# Every SDB select goes through a RequestScheduler, which retries failed
+# requests and limits how many are in flight at once across all threads.
+#
+# Throttling (ServiceUnavailable) and other transient failures are retried
+# after a jittered exponential backoff. A select is retried with the same
+# next_token, so a long query picks up from the last page that came back
+# rather than starting over.
+#
+# The concurrency limit adapts to the throttling we see: it grows by one
+# after each limit's worth of requests that went through, and is halved
+# when a request is throttled. So downloads settle close to the highest
+# request rate SDB will sustain for us.
+import time
+import random
+import threading
+
+# error codes SDB uses when it wants us to slow down
+_throttle_error_codes = ['ServiceUnavailable', 'RequestThrottled', 'Throttling']
+
+def is_throttled(e):
+    return (getattr(e, 'status', None) == 503 or
+            getattr(e, 'error_code', None) in _throttle_error_codes)
+
+# throttling, server errors, and dropped connections are worth retrying;
+# anything else (a bad query, say) would only fail again.
+def is_transient(e):
+    if is_throttled(e):
+        return True
+    status = getattr(e, 'status', None)
+    if status is not None:
+        try:
+            return int(status) >= 500
+        except ValueError:
+            return False
+    return isinstance(e, (IOError, OSError))
+
+class RequestScheduler:
+    def __init__(self, initial_concurrency=8, min_concurrency=1, max_concurrency=32,
+                 max_retries=8, base_delay=0.1, max_delay=20.0, seed=None):
+        self.limit = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_throttled = 0
+        self._in_flight = 0
+        self._successes = 0 # since the limit last changed
+        self._epoch = 0 # counts decreases of the limit
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            self.num_requests += 1
+            return self._epoch
+
+    def _release(self, epoch, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.num_throttled += 1
+                # requests that were already in flight when the limit was
+                # cut get throttled too; only the first of them counts.
+                if epoch == self._epoch:
+                    self.limit = max(self.min_concurrency, self.limit // 2)
+                    self._epoch += 1
+                    self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    # "full jitter": anywhere between no wait and the exponential backoff,
+    # so that threads throttled together don't all come back together.
+    def backoff_delay(self, attempt):
+        with self._cond:
+            return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # calls request() under the concurrency limit, retrying transient failures
+    def call(self, request):
+        attempt = 0
+        while True:
+            epoch = self._acquire()
+            try:
+                result = request()
+            except Exception as e:
+                self._release(epoch, throttled=is_throttled(e))
+                if not is_transient(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                attempt += 1
+                with self._cond:
+                    self.num_retries += 1
+                print('SDB request failed ({}); retrying in {:.2f}s'.format(e, delay))
+                time.sleep(delay)
+                continue
+            self._release(epoch)
+            return result
+
+    def select(self, domain, query, next_token=None):
+        return self.call(lambda: domain.connection.select(domain, query=query,
+                                                          next_token=next_token))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.num_requests,
+                'retries': self.num_retries,
+                'throttled': self.num_throttled,
+                'concurrency_limit': self.limit,
+            }
+
+# shared by every select in sdb_utils, so the limit covers all threads
+default_scheduler = RequestScheduler()
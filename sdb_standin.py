@@ -0,0 +1,139 @@
+# An in-process stand-in for the part of boto's SimpleDB API that sdb_utils
+# uses: connection.get_domain, connection.select with next_token, and
+# domain.name/domain.connection. It understands the queries that
+# sdb_utils.build_sdb_datarange_query produces, and can add latency and
+# throttling to each request, so the download path can be measured offline.
+#
+# Items are made on demand by a function of their row number, so even very
+# large domains don't have to be held in memory.
+import re
+import time
+import random
+import threading
+
+# boto raises SDBResponseError with these attributes; this one has the
+# same shape so that code looking at status/error_code works with either.
+class StandinResponseError(Exception):
+    def __init__(self, status, reason, error_code):
+        Exception.__init__(self, '{} {} ({})'.format(status, reason, error_code))
+        self.status = status
+        self.reason = reason
+        self.error_code = error_code
+
+class StandinItem(dict):
+    def __init__(self, name, attrs):
+        dict.__init__(self, attrs)
+        self.name = name
+
+class StandinResultSet(list):
+    def __init__(self, items, next_token=None):
+        list.__init__(self, items)
+        self.next_token = next_token
+
+class StandinDomain:
+    def __init__(self, connection, name, num_items, make_item):
+        self.connection = connection
+        self.name = name
+        self.num_items = num_items
+        self.make_item = make_item # row number -> (itemName, attributes)
+
+_select_re = re.compile(r'^select (?P<what>.+?) from `(?P<domain>[^`]+)`\s*'
+                        r'(where (?P<where>.+?))?\s*(limit (?P<limit>\d+))?\s*$')
+_condition_re = re.compile(r'^`(?P<attr>[^`]+)` (?P<op>>=|<=|>|<|=|!=) "(?P<value>[^"]*)"$')
+
+_comparisons = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+
+def _parse_conditions(where):
+    conditions = list()
+    if where:
+        for clause in where.strip().split(' AND '):
+            match = _condition_re.match(clause.strip())
+            if not match:
+                raise StandinResponseError(400, 'Bad Request', 'InvalidQueryExpression')
+            conditions.append((match.group('attr'), _comparisons[match.group('op')],
+                               match.group('value')))
+    return conditions
+
+# like SDB, comparisons are between strings, and an item that lacks
+# an attribute in the where clause never matches.
+def _matches(attrs, conditions):
+    for attr, compare, value in conditions:
+        if attr not in attrs or not compare(attrs[attr], value):
+            return False
+    return True
+
+class StandinConnection:
+    # page_size: items per select response (SDB returns at most 2500)
+    # latency: seconds added to every request
+    # throttle_rate: fraction of requests that fail with ServiceUnavailable
+    def __init__(self, page_size=2500, latency=0.0, throttle_rate=0.0, seed=None):
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.domains = dict()
+        self.num_requests = 0
+        self.num_throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def add_domain(self, name, num_items, make_item):
+        self.domains[name] = StandinDomain(self, name, num_items, make_item)
+        return self.domains[name]
+
+    def get_domain(self, domain_name):
+        return self.domains[domain_name]
+
+    def _begin_request(self):
+        with self._lock:
+            self.num_requests += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.num_throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise StandinResponseError(503, 'Service Unavailable', 'ServiceUnavailable')
+
+    def select(self, domain, query, next_token=None):
+        self._begin_request()
+        match = _select_re.match(query.strip())
+        if not match:
+            raise StandinResponseError(400, 'Bad Request', 'InvalidQueryExpression')
+        domain = self.domains[match.group('domain')]
+        conditions = _parse_conditions(match.group('where'))
+        what = match.group('what').strip()
+        limit = int(match.group('limit')) if match.group('limit') else None
+
+        if what == 'count(*)':
+            count = 0
+            for i in range(domain.num_items):
+                if _matches(domain.make_item(i)[1], conditions):
+                    count += 1
+            return StandinResultSet([StandinItem('Domain', {'Count': str(count)})])
+
+        columns = None
+        if what != '*':
+            columns = [col.strip().strip('`') for col in what.split(',')]
+        page_size = min(self.page_size, limit) if limit else self.page_size
+        items = list()
+        i = int(next_token) if next_token else 0
+        while i < domain.num_items and len(items) < page_size:
+            name, attrs = domain.make_item(i)
+            i += 1
+            if not _matches(attrs, conditions):
+                continue
+            if columns is not None:
+                attrs = dict((col, attrs[col]) for col in columns if col in attrs)
+                if not attrs:
+                    continue
+            items.append(StandinItem(name, attrs))
+        if limit or i >= domain.num_items:
+            return StandinResultSet(items)
+        return StandinResultSet(items, next_token=str(i))
@@ -1,8 +1,16 @@
 # a module for interacting with Amazon SimpleDB using Python pandas (and boto of course)
+import numpy as np
 import pandas as pd
 import boto.sdb
 import datetime as dt
+import re
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import dataframe_utils
+import sdb_scheduler
+import instrumentation
+import time
 from datetime_utils import *
 
 class Creds:
@@ -10,46 +18,250 @@ class Creds:
         self.ID = ID
         self.secret = secret
 
+# boto connections are not safe to share between threads, so when we fan out
+# over a worker pool each worker thread lazily opens its own connection.
+class PerThreadConnections:
+    def __init__(self, conn_factory):
+        self.conn_factory = conn_factory
+        self._local = threading.local()
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.conn_factory()
+            self._local.conn = conn
+        return conn
+    def get_domain(self, domain_name):
+        return self.get().get_domain(domain_name)
+
 # a domain is equivalent to a resultset from a select query.
 def make_records_from_resultsets(resultsets):
-    records = list()
-    for itemlist in resultsets:
-        records += [dict(list(item.items()) + [('itemName', item.name)]) for item in itemlist]
+    with instrumentation.stage('make_records') as rec:
+        records = list()
+        for itemlist in resultsets:
+            records += [dict(list(item.items()) + [('itemName', item.name)]) for item in itemlist]
+        rec['items'] = len(records)
     return records
 
-def df_force_numerics(df):
+# Column types that can be declared in a schema. 'str' columns are left alone.
+# An 'int' column that turns out to have missing or fractional values is
+# kept as float rather than truncated.
+def convert_column(series, col_type):
+    if col_type in ('int', 'float'):
+        converted = pd.to_numeric(series, errors='coerce')
+        if col_type == 'float':
+            converted = converted.astype(float)
+        return converted
+    if col_type == 'datetime':
+        # SDB holds our datetimes as isoformat strings, so the format is
+        # given rather than guessed value by value
+        return pd.to_datetime(series, errors='coerce', format='ISO8601')
+    return series
+
+# number of non-null values in a column to look at when guessing its type
+INFERENCE_SAMPLE_SIZE = 1000
+# SDB can only compare strings, so our datetimes are stored as isoformat
+_iso_datetime_re = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+def infer_column_type(series):
+    sample = series.dropna().iloc[:INFERENCE_SAMPLE_SIZE]
+    if len(sample) == 0:
+        return None
+    try:
+        numeric = pd.to_numeric(sample)
+        return 'int' if numeric.dtype.kind in 'iu' else 'float'
+    except (ValueError, TypeError):
+        pass
+    try:
+        if all(_iso_datetime_re.match(value) for value in sample):
+            pd.to_datetime(sample, format='ISO8601')
+            return 'datetime'
+    except (ValueError, TypeError):
+        pass
+    return None
+
+# Converts each column in a single pass, using the type declared for it in
+# schema, or else a type inferred from a sample of its values.
+# Returns a report of {column: (type, number of values that failed to convert)}.
+# Values that fail to convert in a declared column become missing values;
+# a column whose inferred type doesn't hold for every value is left as it was.
+def df_force_numerics(df, schema=None):
+    if schema is None:
+        schema = dict()
+    failures = dict()
     for col in df.columns:
+        declared = col in schema
+        col_type = schema[col] if declared else infer_column_type(df[col])
+        if col_type is None or col_type == 'str':
+            continue
         try:
-            df[col] = df[col].astype(int)
-        except:
-            try:
-                df[col] = df[col].astype(float)
-            except:
-                try:
-                    df[col] = pd.to_datetime(df[col])
-                except:
-                    pass
+            converted = convert_column(df[col], col_type)
+        except (ValueError, TypeError):
+            failures[col] = (col_type, int(df[col].notnull().sum()))
+            continue
+        num_failed = int((df[col].notnull() & converted.isnull()).sum())
+        if num_failed:
+            failures[col] = (col_type, num_failed)
+            if not declared:
+                continue
+        df[col] = converted
+    return failures
+
+# string columns with at most this many distinct values per non-null value
+# are made categorical by compact_dtypes
+CATEGORY_MAX_UNIQUE_FRACTION = 0.5
+
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+def _compact_column(series):
+    kind = series.dtype.kind
+    if kind in 'iu' and isinstance(series.dtype, np.dtype):
+        return pd.to_numeric(series, downcast='unsigned' if kind == 'u' else 'integer')
+    if kind == 'f' and isinstance(series.dtype, np.dtype) and series.dtype.itemsize > 4:
+        # only if every value survives the trip through float32
+        narrowed = series.astype(np.float32)
+        if (narrowed.astype(series.dtype) == series)[series.notnull()].all():
+            return narrowed
+        return series
+    if kind != 'O':
+        return series
+    try:
+        codes, uniques = pd.factorize(series)
+    except TypeError:
+        # multi-valued attributes come back as lists, which can't be hashed
+        return series
+    num_valid = int((codes >= 0).sum())
+    if num_valid == 0 or not all(isinstance(value, str) for value in uniques):
+        return series
+    if len(uniques) <= CATEGORY_MAX_UNIQUE_FRACTION * num_valid:
+        return series.astype('category')
+    if not isinstance(series.dtype, np.dtype):
+        # a pandas string dtype, which doesn't hold python strings
+        return series
+    # mostly distinct strings, like IDs: equal strings come back from SDB as
+    # separate objects, so they're replaced by a single shared one
+    shared = np.asarray(uniques, dtype=object).take(codes)
+    shared[codes < 0] = None
+    return pd.Series(shared, index=series.index, name=series.name)
+
+# Shrinks the dtypes of df in place: integers are downcast to the smallest
+# type that holds them, floats to float32 where no value changes,
+# repetitive string columns (like game_type or pool) become categoricals,
+# and the rest of the string columns share one object per distinct string.
+# Returns the bytes held before and after, as measured by pandas, which
+# doesn't notice the shared strings.
+def compact_dtypes(df):
+    bytes_before = frame_bytes(df)
+    for col in df.columns:
+        series = df[col]
+        compacted = _compact_column(series)
+        if compacted is not series:
+            df[col] = compacted
+    return bytes_before, frame_bytes(df)
+
+# compact_dtypes, reporting the bytes saved
+def compact_df(df, name=''):
+    with instrumentation.stage('compact_dtypes', domain=name or None) as rec:
+        bytes_before, bytes_after = compact_dtypes(df)
+        rec['bytes'] = bytes_before - bytes_after
+    print('{}: compacted from {:.1f} MB to {:.1f} MB ({:.0%} saved)'.format(
+        name, bytes_before / 1e6, bytes_after / 1e6,
+        1 - bytes_after / bytes_before if bytes_before else 0))
+
+def print_conversion_failures(failures, name=''):
+    for col in sorted(failures):
+        col_type, num_failed = failures[col]
+        print('WARNING: {} values in {} column {} could not be converted to {}'.format(
+            num_failed, name, col, col_type))
 
 # this turns a SDB domain into a dataframe, and converts columns to be datetime objects
-def make_dataframe_from_records_with_dates(records, force_numerics=True):
+# with compact, the dtypes are then shrunk by compact_dtypes
+def make_dataframe_from_records_with_dates(records, force_numerics=True, schema=None,
+                                           compact=False):
     if len(records) == 0:
         return pd.DataFrame() # empty dataframe
     df = pd.DataFrame.from_records(records, index='itemName') # SDB always indexes by itemName
     if force_numerics:
-        df_force_numerics(df)
+        print_conversion_failures(df_force_numerics(df, schema))
+    if compact:
+        compact_df(df)
     return df
 
+# Builds a dataframe one result page at a time, appending each item's
+# attributes straight into per-attribute column lists. Attributes that an
+# item doesn't have are filled with None. Multi-valued SDB attributes come
+# back from boto as lists and are stored as-is.
+# Nothing refers to a page once it has been added, so pages can be freed
+# as soon as they are consumed.
+class SdbColumnBuilder:
+    def __init__(self):
+        self.item_names = list()
+        self.columns = dict()
+    def add_resultset(self, resultset):
+        for item in resultset:
+            n = len(self.item_names)
+            for attr, value in item.items():
+                column = self.columns.get(attr)
+                if column is None:
+                    column = [None] * n
+                    self.columns[attr] = column
+                elif len(column) < n:
+                    column.extend([None] * (n - len(column)))
+                column.append(value)
+            self.item_names.append(item.name)
+    def to_dataframe(self):
+        n = len(self.item_names)
+        if n == 0:
+            return pd.DataFrame() # empty dataframe
+        index = pd.Index(self.item_names, name='itemName') # SDB always indexes by itemName
+        data = dict()
+        # release each column list as soon as it has been converted
+        for attr in sorted(self.columns):
+            column = self.columns.pop(attr)
+            column.extend([None] * (n - len(column)))
+            data[attr] = pd.Series(column, index=index, dtype=object)
+        self.item_names = list()
+        return pd.DataFrame(data, index=index)
+
 # this is a convenience function
 # rename to read_sdb
-def make_df_from_sdb(resultsets):
-    return make_dataframe_from_records_with_dates(
-        make_records_from_resultsets(resultsets))
+def make_df_from_sdb(resultsets, force_numerics=True, schema=None, name='', compact=False):
+    builder = SdbColumnBuilder()
+    # resultsets may be downloading pages as we go, so only the time spent
+    # building columns counts towards this stage
+    build_seconds = 0.0
+    num_pages = 0
+    for resultset in resultsets:
+        start = time.time()
+        builder.add_resultset(resultset)
+        build_seconds += time.time() - start
+        num_pages += 1
+    instrumentation.record('build_columns', build_seconds, domain=name or None, pages=num_pages)
+    with instrumentation.stage('to_dataframe', domain=name or None) as rec:
+        df = builder.to_dataframe()
+        rec['items'] = len(df)
+    if force_numerics:
+        with instrumentation.stage('df_force_numerics', domain=name or None) as rec:
+            failures = df_force_numerics(df, schema)
+            rec['items'] = len(df)
+            if instrumentation.enabled:
+                rec['bytes'] = frame_bytes(df)
+        print_conversion_failures(failures, name)
+    if compact:
+        compact_df(df, name)
+    return df
 
+# if start_inclusive is set, items exactly at date_start are included.
+# this is what lets adjacent sub-ranges cover a range without gaps.
 def build_sdb_datarange_query(domain_name, datetime_col=None,
-                              date_start=yesterday(), date_end=None,
-                              select_columns=None):
+                              date_start='yesterday', date_end=None,
+                              select_columns=None, start_inclusive=False,
+                              count_only=False):
+    date_start = resolve_date(date_start)
     query = 'select '
-    if select_columns:
+    if count_only:
+        query += 'count(*) '
+    elif select_columns:
         query += '`' + '`,`'.join(select_columns) + '` '
     else:
         query += '* '
@@ -57,28 +269,232 @@ def build_sdb_datarange_query(domain_name, datetime_col=None,
     if (date_start or date_end) and datetime_col:
         query += 'where '
         if date_start:
-            query += '`' + datetime_col + '` > "' + date_start.isoformat() + '" '
+            query += '`' + datetime_col + '` ' + ('>=' if start_inclusive else '>')
+            query += ' "' + date_start.isoformat() + '" '
             if date_end:
                 query += 'AND '
         if date_end:
             query += '`' + datetime_col + '` < "' + date_end.isoformat() + '" '
     return query
 
-def download_dtrange_from_domain(domain, datetime_col=None,
-                                 date_start=yesterday(), date_end=None,
-                                 select_columns=None):
+# SDB refuses select expressions that name more attributes than this
+SDB_MAX_SELECT_ATTRIBUTES = 20
+
+# the attribute names present on a sample of the items in a date range.
+# attributes that are rare in the domain may not show up in the sample.
+def probe_attribute_names(domain, datetime_col=None, date_start=None, date_end=None,
+                          sample_size=250):
     query = build_sdb_datarange_query(domain.name, datetime_col=datetime_col,
-                                      date_start=date_start, date_end=None,
-                                      select_columns=None)
-    return from_sdb_query(domain, query)
+                                      date_start=date_start, date_end=date_end)
+    query += 'limit ' + str(sample_size)
+    names = set()
+    resultset = sdb_scheduler.default_scheduler.select(domain, query)
+    for item in resultset:
+        names.update(item.keys())
+    return names
 
-def from_sdb_query(domain, query):
-    rsets = list()
+# SDB answers a count(*) query with a single 'Domain' item per page
+# holding a 'Count' attribute. Long counts may be split over several pages.
+def count_sdb_query(domain, query):
+    count = 0
+    for resultset in from_sdb_query(domain, query):
+        for item in resultset:
+            count += int(item['Count'])
+    return count
+
+# splits [date_start, date_end) into n contiguous sub-ranges of equal length
+def split_datetime_range(date_start, date_end, n):
+    step = (date_end - date_start) / n
+    bounds = [date_start] + [(date_start + step * i).replace(microsecond=0)
+                             for i in range(1, n)] + [date_end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# partition sizing for partitions='auto'
+ITEMS_PER_PARTITION = 20000
+MAX_AUTO_PARTITIONS = 16
+
+def choose_partition_count(domain, datetime_col, date_start, date_end):
+    query = build_sdb_datarange_query(domain.name, datetime_col=datetime_col,
+                                      date_start=date_start, date_end=date_end,
+                                      count_only=True)
+    count = count_sdb_query(domain, query)
+    n = -(-count // ITEMS_PER_PARTITION) # ceiling division
+    return max(1, min(n, MAX_AUTO_PARTITIONS))
+
+# Partitions may overlap at their edges, and an item whose datetime changes
+# during the scan can show up in two partitions, so we keep only the first
+# copy of every itemName.
+def iter_unique_resultsets(resultsets):
+    seen_names = set()
+    for resultset in resultsets:
+        unique_items = list()
+        for item in resultset:
+            if item.name not in seen_names:
+                seen_names.add(item.name)
+                unique_items.append(item)
+        yield unique_items
+
+# partitions may be a number of sub-ranges of [date_start, date_end) on
+# datetime_col to scan in parallel, or 'auto' to size them from a
+# select count(*) so that small domains stay a single query.
+# Parallel scans need conn_factory so that each worker has its own
+# connection; without one, the partitions are scanned one after another.
+# Result pages are yielded as they arrive, so that callers can consume
+# and free them one at a time.
+def iter_dtrange_from_domain(domain, datetime_col=None,
+                             date_start='yesterday', date_end=None,
+                             select_columns=None, partitions=1,
+                             conn_factory=None, max_workers=None,
+                             start_inclusive=False):
+    date_start = resolve_date(date_start)
+    if partitions != 1 and datetime_col and date_start:
+        if partitions == 'auto':
+            partitions = choose_partition_count(domain, datetime_col, date_start, date_end)
+        if partitions > 1:
+            return iter_partitioned_dtrange_from_domain(
+                domain, datetime_col, date_start, date_end, partitions,
+                select_columns=select_columns, conn_factory=conn_factory,
+                max_workers=max_workers, start_inclusive=start_inclusive)
+    query = build_sdb_datarange_query(domain.name, datetime_col=datetime_col,
+                                      date_start=date_start, date_end=date_end,
+                                      select_columns=select_columns,
+                                      start_inclusive=start_inclusive)
+    return iter_sdb_query(domain, query)
+
+def download_dtrange_from_domain(domain, datetime_col=None,
+                                 date_start='yesterday', date_end=None,
+                                 select_columns=None, partitions=1,
+                                 conn_factory=None, max_workers=None,
+                                 start_inclusive=False):
+    return list(iter_dtrange_from_domain(
+        domain, datetime_col=datetime_col, date_start=date_start, date_end=date_end,
+        select_columns=select_columns, partitions=partitions, conn_factory=conn_factory,
+        max_workers=max_workers, start_inclusive=start_inclusive))
+
+_partition_done = object()
+
+# if date_end is None, the range is split up to now, but the last
+# sub-range is left open, the same as an unpartitioned query.
+def iter_partitioned_dtrange_from_domain(domain, datetime_col, date_start, date_end,
+                                         partitions, select_columns=None, conn_factory=None,
+                                         max_workers=None, start_inclusive=False):
+    sub_ranges = split_datetime_range(date_start, date_end or now(), partitions)
+    queries = list()
+    for i, (sub_start, sub_end) in enumerate(sub_ranges):
+        if i == len(sub_ranges) - 1:
+            sub_end = date_end
+        # only the first sub-range keeps the caller's choice of start
+        queries.append(build_sdb_datarange_query(domain.name, datetime_col=datetime_col,
+                                                 date_start=sub_start, date_end=sub_end,
+                                                 select_columns=select_columns,
+                                                 start_inclusive=(i > 0 or start_inclusive)))
+    if conn_factory is None:
+        return iter_unique_resultsets(
+            resultset for q in queries for resultset in iter_sdb_query(domain, q))
+    return iter_unique_resultsets(_iter_parallel_queries(domain, queries, conn_factory,
+                                                         max_workers))
+
+# the partition scans of every domain share one pool of this many
+# workers, so that downloading several domains at once doesn't multiply
+# the number of threads (and connections) by the number of partitions.
+MAX_PARTITION_WORKERS = 16
+_partition_pool = None
+_partition_pool_lock = threading.Lock()
+
+def _get_partition_pool():
+    global _partition_pool
+    with _partition_pool_lock:
+        if _partition_pool is None:
+            _partition_pool = ThreadPoolExecutor(max_workers=MAX_PARTITION_WORKERS,
+                                                 thread_name_prefix='partition')
+        return _partition_pool
+
+# pages that may wait in the queue for each worker. a worker that gets
+# this far ahead of the caller waits for it, so pages can't pile up.
+PAGES_PER_WORKER = 2
+
+# the workers hand their pages over through a queue as soon as each one
+# arrives, so pages come out in arrival order rather than partition order.
+# the queries run in the shared partition pool, unless max_workers asks
+# for a pool of their own.
+def _iter_parallel_queries(domain, queries, conn_factory, max_workers=None):
+    if max_workers:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor = _get_partition_pool()
+    num_workers = min(len(queries), max_workers or MAX_PARTITION_WORKERS)
+    pages = queue.Queue(maxsize=PAGES_PER_WORKER * num_workers)
+    cancelled = threading.Event()
+    worker_conns = PerThreadConnections(conn_factory)
+    def query_in_worker(query):
+        try:
+            if cancelled.is_set():
+                return
+            for resultset in iter_sdb_query(worker_conns.get_domain(domain.name), query):
+                pages.put(resultset)
+                if cancelled.is_set():
+                    break
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(_partition_done)
+    futures = [executor.submit(query_in_worker, query) for query in queries]
+    remaining = len(queries)
+    try:
+        while remaining:
+            page = pages.get()
+            if page is _partition_done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        # after an error, or if the caller stops early, the scans that
+        # haven't started are called off, and the others are stopped at
+        # their next page. the queue is drained until they're all done,
+        # so none is left waiting to put a page.
+        cancelled.set()
+        for future in futures:
+            if future.cancel():
+                remaining -= 1
+        while remaining:
+            if pages.get() is _partition_done:
+                remaining -= 1
+        if executor is not _partition_pool:
+            executor.shutdown()
+
+# the size of a page's payload: the characters of its item names,
+# attribute names and values (multi-valued attributes have a list)
+def resultset_bytes(resultset):
+    nbytes = 0
+    for item in resultset:
+        nbytes += len(item.name)
+        for attr, value in item.items():
+            nbytes += len(attr)
+            if isinstance(value, list):
+                nbytes += sum(len(v) for v in value)
+            else:
+                nbytes += len(value)
+    return nbytes
+
+# every page is requested through sdb_scheduler.default_scheduler, which
+# retries a failed page with the same next_token, so the query carries on
+# from the last page that came back.
+def iter_sdb_query(domain, query):
     print('Performing SDB query: ' + query)
-    resultset = domain.connection.select(domain, query=query)
-    while resultset.next_token:
-        rsets.append(resultset)
-        resultset = domain.connection.select(domain, query=query, next_token=resultset.next_token)
-    rsets.append(resultset)
-    return rsets
-    
+    scheduler = sdb_scheduler.default_scheduler
+    next_token = None
+    while True:
+        with instrumentation.stage('sdb_select', domain=domain.name, pages=1) as rec:
+            resultset = scheduler.select(domain, query, next_token=next_token)
+            rec['items'] = len(resultset)
+            if instrumentation.enabled:
+                rec['bytes'] = resultset_bytes(resultset)
+        yield resultset
+        next_token = resultset.next_token
+        if not next_token:
+            break
+
+def from_sdb_query(domain, query):
+    return list(iter_sdb_query(domain, query))
@@ -4,36 +4,189 @@
 # it is intended to mirror the capabilities of R.
 # it takes a little while to get used to, but is extraordinarily powerful and fast.
 
+import startup
 import sys, os
+import argparse
 import re
-import pandas as pd
 import datetime as dt
 import readline
-import dubois
-from sdb_utils import *
 from interactive_utils import *
 import datetime_utils
+import instrumentation
+
+# numpy, pandas and dubois (and boto through it) are slow to import, so
+# they're imported by _import_heavy_modules: straight away when this module
+# is imported by something else, but in the background when it's run as a
+# script, so that the first prompt doesn't wait for them.
+np = pd = dubois = dataframe_utils = None
+basic_def_cols = None
+
+def _import_heavy_modules():
+    global np, pd, dubois, dataframe_utils, basic_def_cols
+    import numpy as np
+    import pandas as pd
+    import dataframe_utils
+    import dubois
+    basic_def_cols = dubois.basic_def_cols
+
+if __name__ != '__main__':
+    _import_heavy_modules()
 
 def xstr(s):
     if s is None:
         return ''
     return str(s)
 
-basic_def_cols = [
-    'name',
-    'start',
-    'game_type',
-    'level_at_end',
-    'value',
-    'solution', 'level', 'pool', 'num_errors',
-    'time_elapsed', 'solved', 'repr_type', 'repr_level',
-    'repr_descrip',
-    'correct', 'num_solved', 'answer',
-    'score', 'level_integer', 'level_fraction', 'notes',
-    ]
-
-def interactive_dataframe_display(df, def_cols=basic_def_cols, prefix=None):
-    completer = Completer(list(df) + ['?defaults'])
+# rows shown at once by interactive_dataframe_display
+DISPLAY_PAGE_ROWS = 40
+
+def _format_value(value):
+    if value is None or (not isinstance(value, (list, tuple)) and pd.isnull(value)):
+        return 'NaN'
+    if isinstance(value, float):
+        return '{:.{}f}'.format(value, pd.get_option('display.precision'))
+    return str(value)
+
+# Shows one page of a dataframe at a time. Only the rows on the page are
+# formatted, so moving around costs the same no matter how long the frame
+# is. Column widths are remembered as pages are shown (they only ever
+# grow), so that columns don't jump around from page to page.
+class DataframeViewport:
+    def __init__(self, df, page_rows=DISPLAY_PAGE_ROWS):
+        self.df = df
+        self.page_rows = page_rows
+        self.start = 0
+        self.widths = dict((col, len(str(col))) for col in df)
+
+    def _format_page(self):
+        page = self.df.iloc[self.start:self.start + self.page_rows]
+        columns = list()
+        for i, col in enumerate(self.df):
+            values = [_format_value(v) for v in page.iloc[:, i]]
+            self.widths[col] = max([self.widths[col]] + [len(v) for v in values])
+            columns.append(values)
+        header = '  '.join(str(col).rjust(self.widths[col]) for col in self.df)
+        rows = ['  '.join(values[r].rjust(self.widths[col])
+                          for col, values in zip(self.df, columns))
+                for r in range(len(page))]
+        return header, rows
+
+    def show(self):
+        with instrumentation.stage('display_render') as rec:
+            header, rows = self._format_page()
+            print(header)
+            for row in rows:
+                print(row)
+            print(header) # reprint header row
+            rec['rows'] = len(rows)
+        if len(self.df) == 0:
+            print('no rows')
+            return
+        end = min(self.start + self.page_rows, len(self.df))
+        print('rows {}-{} of {} (:n next, :p previous, :<row> jump, :all show everything)'.format(
+            self.start, end - 1, len(self.df)))
+
+    def jump(self, row):
+        last_page_start = max(0, len(self.df) - self.page_rows)
+        self.start = min(max(0, row), last_page_start)
+        self.show()
+
+    # cmd is what was typed after the ':'
+    def navigate(self, cmd):
+        if cmd == 'n':
+            self.jump(self.start + self.page_rows)
+        elif cmd == 'p':
+            self.jump(self.start - self.page_rows)
+        elif cmd == 'all':
+            df_str = self.df.to_string(index=False)
+            print(df_str)
+            print(df_str.split('\n', 1)[0]) # reprint header row
+        elif cmd.isdigit():
+            self.jump(int(cmd))
+        else:
+            print('unknown navigation command :' + cmd)
+
+# The filters and sorts typed in DISPLAY mode stay in effect until they
+# are removed, as a pipeline of steps. The result of every step is cached
+# as an array of row positions into the full frame, so a new step only
+# refines the last result, and removing a step only recomputes the steps
+# after it. With a column_index.ColumnIndexManager for the frame, steps
+# are answered from its sorted column indexes where possible.
+class DisplayPipeline:
+    def __init__(self, df, column_index=None):
+        self.df = df
+        self.column_index = column_index
+        self.steps = list() # ('filter', column, op, value) or ('sort', column, '+' or '-', '')
+        self.positions = list() # row positions after each step
+
+    # None means all rows, in frame order
+    def current_positions(self):
+        if self.positions:
+            return self.positions[-1]
+        return None
+
+    def _apply_indexed(self, step, positions):
+        kind, col, op, value = step
+        if kind == 'sort':
+            return self.column_index.sorted_positions(self.df, col, ascending=(op == '+'),
+                                                      positions=positions)
+        return self.column_index.filter_positions(self.df, col, op, value,
+                                                  positions=positions)
+
+    # only the step's column is taken from the rows still in the result,
+    # with its index replaced by their row positions, so that whatever
+    # rows survive (and in whatever order) can be read off the index.
+    def _apply(self, step, positions):
+        if self.column_index is not None:
+            result = self._apply_indexed(step, positions)
+            if result is not None:
+                return result
+        kind, col, op, value = step
+        if positions is None:
+            positions = np.arange(len(self.df))
+        sub = self.df.iloc[positions, [self.df.columns.get_loc(col)]]
+        sub.index = positions
+        if kind == 'sort':
+            sub = sub.sort_values(col, ascending=(op == '+'), kind='mergesort')
+        else:
+            sub = dataframe_utils.where(sub, col, op, value)
+        return sub.index.values
+
+    def push(self, step):
+        self.positions.append(self._apply(step, self.current_positions()))
+        self.steps.append(step)
+
+    # i is the number ?steps shows. it is checked before anything changes,
+    # since a negative i would leave the positions out of step with the steps.
+    def remove(self, i):
+        if not 0 <= i < len(self.steps):
+            raise IndexError('no step {}'.format(i))
+        del self.steps[i]
+        del self.positions[i:]
+        for step in self.steps[i:]:
+            self.positions.append(self._apply(step, self.current_positions()))
+
+    def clear(self):
+        self.steps = list()
+        self.positions = list()
+
+    def describe(self):
+        return ['{}: {} {}{}{}'.format(i, kind, col, op, value)
+                for i, (kind, col, op, value) in enumerate(self.steps)]
+
+    def result(self, columns):
+        col_positions = [self.df.columns.get_loc(col) for col in columns]
+        if self.current_positions() is None:
+            return self.df.iloc[:, col_positions]
+        return self.df.iloc[self.current_positions(), col_positions]
+
+# column_index, if given, is a column_index.ColumnIndexManager for df
+# def_cols defaults to dubois.basic_def_cols
+def interactive_dataframe_display(df, def_cols=None, prefix=None, column_index=None):
+    if def_cols is None:
+        def_cols = basic_def_cols
+    completer = Completer(list(df) + ['?defaults', '?steps', '?drop', '?clear',
+                                      ':n', ':p', ':all'])
     readline.set_completer(completer.complete)
 
     comparison_regex_str = '(\w+)(' + '|'.join(dataframe_utils.comparison_ops_dict.keys()) + ')' + '(.*)'
@@ -42,6 +195,7 @@ def interactive_dataframe_display(df, def_cols=basic_def_cols, prefix=None):
     print(', '.join(dataframe_utils.comparison_ops_dict.keys()))
     
     print('Columns can be sorted by typing their name and adding a direction specifier, + or -')
+    print('Filters and sorts stay in effect. ?steps lists them, ?drop N removes one, ?clear removes all.')
     sort_regex_str = '(\w+)(-|\+)'
     sort_re = re.compile(sort_regex_str)
     
@@ -52,38 +206,51 @@ def interactive_dataframe_display(df, def_cols=basic_def_cols, prefix=None):
     if not def_cols:
         def_cols = list(df)
     display_cols = [col for col in def_cols if col in list(df)]
+    pipeline = DisplayPipeline(df, column_index=column_index)
+    viewport = None
 
     while True:
         try:
             print(xstr(prefix) + ' DISPLAY > Press Enter for defaults, ' +
                   'TAB to complete column names, or Ctrl-C to exit DISPLAY.')
             new_display_cols = raw_input(xstr(prefix) + ' DISPLAY >>> ')
+            if new_display_cols.startswith(':'):
+                if viewport is not None:
+                    viewport.navigate(new_display_cols[1:].strip())
+                continue
             if new_display_cols:
                 if new_display_cols == '?defaults':
                     print(xstr(prefix) + ' DISPLAY > DEFAULTS: ' + ', '.join(display_cols))
                     continue
+                elif new_display_cols == '?steps':
+                    print(xstr(prefix) + ' DISPLAY > STEPS: ' + '; '.join(pipeline.describe()))
+                    continue
+                elif new_display_cols == '?clear':
+                    pipeline.clear()
+                    new_display_cols = list()
+                elif new_display_cols.startswith('?drop'):
+                    try:
+                        pipeline.remove(int(new_display_cols[len('?drop'):]))
+                    except (ValueError, IndexError):
+                        print('?drop needs the number of a step; see ?steps')
+                        continue
+                    new_display_cols = list()
                 else:
                     new_display_cols = new_display_cols.split(' ')
 
-            query_strs = list()
-            display_df = df
-
             for dc in new_display_cols:
                 try:
                     cmpr = comp_re.match(dc)
                     srt = sort_re.match(dc)
                     if cmpr:
                         print('filtering {} by {}'.format(cmpr.group(1), cmpr.group(3)))
-                        display_df = dataframe_utils.where(display_df, cmpr.group(1),
-                                                           cmpr.group(2), cmpr.group(3))
+                        pipeline.push(('filter', cmpr.group(1), cmpr.group(2), cmpr.group(3)))
                         if cmpr.group(1) in display_cols:
                             display_cols.remove(cmpr.group(1))
                         display_cols.insert(0, cmpr.group(1)) # we can put this all the way on the left
                     elif srt:
                         print('sorting by ' + srt.group(1))
-                        display_df = display_df.sort(srt.group(1),
-                                                     ascending=(srt.group(2)=='+'),
-                                                     kind='mergesort')
+                        pipeline.push(('sort', srt.group(1), srt.group(2), ''))
                         if srt.group(1) not in display_cols:
                             display_cols.append(srt.group(1))
                     elif dc in display_cols:
@@ -101,28 +268,65 @@ def interactive_dataframe_display(df, def_cols=basic_def_cols, prefix=None):
                     pass
                 
             # verify sanity of input - don't crash because a column doesn't exist
-            display_cols = [col for col in display_cols if col in list(display_df)]
-            display_df = display_df[display_cols]
-            df_str = display_df.to_string(index=False)
-            print(df_str)
-            print(df_str.split('\n', 1)[0]) # reprint header row
+            display_cols = [col for col in display_cols if col in list(df)]
+            display_df = pipeline.result(display_cols)
+            viewport = DataframeViewport(display_df)
+            viewport.show()
         except KeyboardInterrupt:
             print('')
             break
 
 # this is just a goofy, experimental interactive interface
-def browse_dataframes(df_browser):
+# looks text up in the value index of df_browser and prints the hits,
+# numbered so that ?show can display their rows
+def find_values(df_browser, text):
+    not_loaded = [name for name in df_browser.get_known_names()
+                  if not df_browser.is_loaded(name)]
+    if not_loaded:
+        print('Not searching ' + ', '.join(not_loaded) + ', which have not been loaded yet.')
+    hits = df_browser.get_value_index().find(text)
+    if not hits:
+        print('Found nothing matching ' + text)
+    for i, (name, col, positions) in enumerate(hits):
+        print('{:>3}: {}.{}: {} rows'.format(i, name, col, len(positions)))
+    return hits
+
+# shows the rollup view called name, or lists the views if name is empty
+def show_rollup(rollups, name):
+    if not name:
+        print('Rollup views are ' + ', '.join(rollups.view_names()))
+        return
+    try:
+        view = rollups.get(name)
+    except KeyError:
+        print(name + ' isn\'t a rollup view. Type ?rollup to list them.')
+        return
+    except (TypeError, ValueError, AttributeError) as e:
+        print('Could not compute {}: {}'.format(name, e))
+        return
+    view = view.reset_index()
+    interactive_dataframe_display(view, def_cols=list(view), prefix=name)
+
+# rollups, if given, is a rollups.RollupManager whose views ?rollup shows
+def browse_dataframes(df_browser, rollups=None):
     # print instructions
     known_df_names = df_browser.get_known_names()
     print('')
     print('Available dataframes are ' + ', '.join(known_df_names))
     print('Type dataframe names to merge them. Press Ctrl-C to return before the previous merge.')
     print('Press Enter to display current merged dataframe')
-    vcmds_completer = Completer(known_df_names)
+    print('Type ?find VALUE to find an ID or a word in every dataframe, '
+          'and ?show N to display the rows of hit N.')
+    extra_cmds = ['?find', '?show']
+    if rollups is not None:
+        print('Type ?rollup to list the rollup views, and ?rollup NAME to display one.')
+        extra_cmds += ['?rollup'] + rollups.view_names()
+    vcmds_completer = Completer(known_df_names + extra_cmds)
 
     ptag = ' >>> '
     df_stack = list()
     current_df = None
+    last_hits = list()
     
     while True:
         try:
@@ -134,11 +338,41 @@ def browse_dataframes(df_browser):
                 prompt = ptag
             
             cmdline = raw_input(prompt).strip()
+            if cmdline.startswith('?find'):
+                text = cmdline[len('?find'):].strip()
+                if text:
+                    last_hits = find_values(df_browser, text)
+                else:
+                    print('Type ?find followed by the ID or word to look for.')
+                continue
+            if cmdline.startswith('?rollup') and rollups is not None:
+                show_rollup(rollups, cmdline[len('?rollup'):].strip())
+                continue
+            if cmdline.startswith('?show'):
+                try:
+                    name, col, positions = last_hits[int(cmdline[len('?show'):])]
+                except (ValueError, IndexError):
+                    print('Type ?show followed by the number of a hit from ?find.')
+                    continue
+                print('Rows of {} where {} matched'.format(name, col))
+                interactive_dataframe_display(df_browser[name].iloc[positions])
+                continue
             tokens = cmdline.split(' ')
             if len(tokens) < 1 or not cmdline:
                 if current_df is not None:
-                    interactive_dataframe_display(current_df)
+                    interactive_dataframe_display(
+                        current_df, column_index=df_browser.get_column_index(current_df))
                     
+            # a whole chain of names typed at once can be merged in a single pass
+            chain = [tok for tok in tokens if tok]
+            if current_df is None and len(chain) > 1:
+                try:
+                    current_df = df_browser.merge_chain(chain)
+                    print('Merged ' + df_browser.get_known_name(current_df))
+                    tokens = list()
+                except (KeyError, ValueError) as e:
+                    print(str(e) + ', so merging them one at a time')
+
             # if we are doing standard merge
             if current_df is None and len(tokens) > 0:
                 df_name = tokens.pop()
@@ -173,26 +407,99 @@ def browse_dataframes(df_browser):
                 else:
                     break
 
-def start_interactive_query_loop(conn):
+# select_columns is passed along to the downloads; see dubois._download_domain_df.
+# encode_keys is passed along too; see dubois.encode_domain_keys.
+# with lazy, domains are only downloaded (or read) when first merged or displayed.
+# with index_values, string values are indexed for ?find as each domain is
+# loaded, rather than all at once on the first ?find.
+# with compact, downloaded domains get smaller dtypes; see sdb_utils.compact_dtypes.
+# warm, if given, is a startup.Warmup that imports the heavy modules and
+# returns the SDB connection (in place of conn). It is only waited for once
+# the first date has been typed.
+def start_interactive_query_loop(conn, select_columns=None, encode_keys=False, lazy=False,
+                                 index_values=False, compact=False, warm=None):
     print('Welcome to the DuBois Project Data Explorer!')
     print('Press TAB twice at any time to view the available commands or options.')
     print('Use Ctrl-C to return to previous level, and Ctrl-D to quit.')
     # start readline
     readline.parse_and_bind('tab: complete')
+    instrumentation.record('startup', startup.seconds_since_start())
 
+    df_browser = None
+    rollups = None
+    window_start = None # date_start of the last download, if there was one
     while True:
         try:
-            # local_data = raw_input('type a dirname to use local data, or press enter to download')
-            # if local_data and os.path.exists(local_data):
-
             print('How far back should I download?')
-            start = datetime_utils.ask_for_date()
-            df_browser = dubois.download_recent_domain_data(conn, date_start=start)
-            browse_dataframes(df_browser)
+            extra_choices = list()
+            if startup.may_have_local_data(warm):
+                print('Or type local to reopen the data saved by the last download.')
+                extra_choices.append('local')
+            if df_browser is not None:
+                print('Or type sync to fetch only what is new since the last download.')
+                extra_choices.append('sync')
+            start = datetime_utils.ask_for_date(extra_choices=extra_choices)
+            if warm is not None:
+                conn = warm.result()
+                instrumentation.record('warmup', warm.seconds)
+                warm = None
+            if start == 'local' and not dubois.has_local_domain_data():
+                print('There is no complete local copy of the data to reopen.')
+                continue
+            if start == 'local':
+                df_browser = dubois.load_local_domain_data(encode_keys=encode_keys, lazy=lazy,
+                                                           index_values=index_values)
+            elif start == 'sync':
+                df_browser = dubois.sync_domain_data(
+                    conn, df_browser, max_workers=dubois.DEFAULT_DOWNLOAD_WORKERS,
+                    partitions=dubois.DEFAULT_DOWNLOAD_PARTITIONS,
+                    select_columns=select_columns, encode_keys=encode_keys, compact=compact,
+                    window_start=window_start)
+            else:
+                window_start = start
+                df_browser = dubois.download_recent_domain_data(
+                    conn, date_start=start, max_workers=dubois.DEFAULT_DOWNLOAD_WORKERS,
+                    partitions=dubois.DEFAULT_DOWNLOAD_PARTITIONS,
+                    select_columns=select_columns, encode_keys=encode_keys, lazy=lazy,
+                    index_values=index_values, compact=compact)
+            if rollups is None:
+                rollups = dubois.make_rollups()
+            # a sync only adds rows, so the views just fold those in
+            rollups.set_merger(df_browser, incremental=(start == 'sync'))
+            browse_dataframes(df_browser, rollups=rollups)
         except (KeyboardInterrupt, EOFError) as e:
             print('\nLeaving the DuBois Project Data Explorer.')
             break
 
 if __name__ == '__main__':
-    conn = dubois.get_admin_conn()
-    start_interactive_query_loop(conn)
+    parser = argparse.ArgumentParser(description='Browse DuBois Project data.')
+    parser.add_argument('--auto-columns', action='store_true',
+                        help='download only the columns used for display and merging')
+    parser.add_argument('--encode-keys', action='store_true',
+                        help='encode foreign keys and itemNames as shared categoricals for faster merges')
+    parser.add_argument('--lazy', action='store_true',
+                        help='download each domain only when it is first merged or displayed')
+    parser.add_argument('--index-values', action='store_true',
+                        help='index string values for ?find as each domain is loaded')
+    parser.add_argument('--compact-dtypes', action='store_true',
+                        help='downcast numbers and make repetitive strings categorical '
+                        'to save memory')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='time every stage and write a JSON report here on exit')
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable()
+    def warm_up():
+        _import_heavy_modules()
+        return dubois.get_admin_conn()
+    try:
+        start_interactive_query_loop(None, select_columns='auto' if args.auto_columns else None,
+                                     encode_keys=args.encode_keys, lazy=args.lazy,
+                                     index_values=args.index_values,
+                                     compact=args.compact_dtypes,
+                                     warm=startup.Warmup(warm_up))
+    finally:
+        if args.profile:
+            instrumentation.print_summary()
+            instrumentation.dump(args.profile)
+            print('Wrote profile to ' + args.profile)
@@ -1,72 +1,293 @@
+import numpy as np
 import pandas as pd
+import weakref
+import column_index
+import instrumentation
+import value_index
+from collections import OrderedDict
 
 # smart frame functions (to make dataframes themselves 'smart')
+_smart_frame_attrs = ['__sf_suffix', '__sf_foreign_keys', '__sf_handle', '__sf_is_smart_frame']
+
 def is_smart_frame(df):
     return hasattr(df, '__sf_is_smart_frame')
-def make_df_smart(df, suffix):
-    try:
-        if is_smart_frame(df):
-            print('WHOA THIS DATAFRAME IS ALREADY SMART')
-            return df
-    except:
-        pass
-    # okay, so it isn't already a 'smart' frame.
+# handle is the identifier the DataframeSmartMerger gives the frame. Unlike
+# id(), a handle is never reused after its frame has been freed.
+# foreign_keys is the {target handle: foreign key} dict owned by the merger.
+def make_df_smart(df, suffix, handle=None, foreign_keys=None):
+    # pandas copies _metadata attributes onto frames derived from a smart
+    # frame (merges, slices, copies), so a frame may look smart while only
+    # being derived from one. it always gets attributes of its own here.
     df.__sf_suffix = suffix
-    df.__sf_foreign_keys = dict()
+    df.__sf_foreign_keys = foreign_keys if foreign_keys is not None else dict()
+    df.__sf_handle = handle
     df.__sf_is_smart_frame = True
-    df._metadata.append('__sf_suffix')
-    df._metadata.append('__sf_foreign_keys')
-    df._metadata.append('__sf_is_smart_frame')
+    # _metadata is shared by every DataFrame, so only add our names once
+    for attr in _smart_frame_attrs:
+        if attr not in df._metadata:
+            df._metadata.append(attr)
     return df
 
 def suffix(smart_df):
     return smart_df.__sf_suffix
 def fkeys(smart_df): # foreign key
     return smart_df.__sf_foreign_keys
+def handle(smart_df):
+    return smart_df.__sf_handle
 
-def get_fkey_for_dfid(smart_df, target_df_id):
-    return fkeys(smart_df)[target_df_id]
+def get_fkey_for_handle(smart_df, target_handle):
+    return fkeys(smart_df)[target_handle]
 def get_fkey(smart_df, target_df):
-    return get_fkey_for_dfid(smart_df, id(target_df))
+    try:
+        return get_fkey_for_handle(smart_df, handle(target_df))
+    except AttributeError: # not a smart frame
+        raise KeyError(target_df)
 
-def add_fkey_for_dfid(smart_df, target_df_id, fkey):
-    fkeys(smart_df)[target_df_id] = fkey
-def add_fkey(smart_df, target_df, fkey): # gets id and passes along
-    add_fkey_for_dfid(smart_df, id(target_df), fkey)
+def add_fkey_for_handle(smart_df, target_handle, fkey):
+    fkeys(smart_df)[target_handle] = fkey
+def add_fkey(smart_df, target_df, fkey): # gets handle and passes along
+    add_fkey_for_handle(smart_df, handle(target_df), fkey)
 
 def sf_has_target(smart_df, target_df):
-    if id(target_df) in fkeys(smart_df):
-        return True
-    return False
+    try:
+        return handle(target_df) in fkeys(smart_df)
+    except AttributeError: # not a smart frame
+        return False
+
+# this is only an estimate - object columns count as one pointer per value
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=False).sum())
+
+# A least-recently-used cache of merge results that holds at most
+# max_bytes worth of frames (as estimated by frame_nbytes).
+class MergeCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._merged = OrderedDict() # key -> (merged df, nbytes)
+    def __len__(self):
+        return len(self._merged)
+    def get(self, key):
+        try:
+            merged, nbytes = self._merged.pop(key)
+        except KeyError:
+            return None
+        self._merged[key] = (merged, nbytes) # now the most recently used
+        return merged
+    def put(self, key, merged):
+        self.discard(key)
+        nbytes = frame_nbytes(merged)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        self._merged[key] = (merged, nbytes)
+        self.nbytes += nbytes
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self._evict_oldest()
+    def discard(self, key):
+        if key in self._merged:
+            self.nbytes -= self._merged.pop(key)[1]
+    # drops every merge that had the named frame as one of its components.
+    # the name may itself be a merged name like 'answers+challenges'.
+    def discard_involving(self, name):
+        for key in list(self._merged.keys()):
+            if name in [key[0], key[1]] + key[0].split('+') + key[1].split('+'):
+                self.discard(key)
+    def _evict_oldest(self):
+        key, (merged, nbytes) = self._merged.popitem(last=False)
+        self.nbytes -= nbytes
+    def clear(self):
+        self._merged.clear()
+        self.nbytes = 0
+
+DEFAULT_MERGE_CACHE_BYTES = 512 * 1024 * 1024
 
 class DataframeSmartMerger(object):
-    def __init__(self):
-        self._smart_frames = dict()
-        self._names_of_dfs_known_to_be_smart = dict()
-        self._smart_frames_which_have_a_foreign_key_for_this_dfid = dict()
-    def add(self, df, name, suffix=None):
+    # Every frame that is added gets a handle, and foreign keys refer to
+    # frames by handle. Frames added directly are base frames, and are kept
+    # for the life of the merger. Frames made by merges are only referenced
+    # weakly: they live for as long as the merge cache or the caller holds
+    # them, and once freed they are forgotten, along with every foreign key
+    # that referred to them.
+    # Base frames may also be added lazily, as a function that loads the
+    # frame; the name and handle are known right away, so smart merges can
+    # be registered for it, but the loader is only called the first time
+    # the frame itself is needed.
+    # With a value_index.ValueIndex, every base frame is added to it as it
+    # is added (or loaded), so that values can be looked up across frames.
+    # Merge results are cached so that repeating a merge is instant, and
+    # merge_cache_bytes bounds the memory held by the cache (None for no
+    # bound), which is also what bounds the memory held by merged frames
+    # nobody else is using.
+    def __init__(self, merge_cache_bytes=DEFAULT_MERGE_CACHE_BYTES, value_index=None):
+        self._smart_frames = dict() # name -> base frame
+        self._frames_by_handle = dict() # handle -> weakref to frame
+        self._handles_by_name = dict()
+        self._names_by_handle = dict()
+        self._foreign_keys = dict() # handle -> {target handle: foreign key}
+        self._handles_which_have_a_foreign_key_for_this_handle = dict()
+        self._next_handle = 0
+        self._freed_handles = list()
+        self._merge_cache = MergeCache(merge_cache_bytes)
+        self._column_indexes = dict() # handle -> column_index.ColumnIndexManager
+        self._lazy_loaders = dict() # handle -> (loader, suffix) of frames not loaded yet
+        self.value_index = value_index
+    # derived frames are the ones made by merges
+    def add(self, df, name, suffix=None, derived=False):
         print('adding dataframe ' + name)
+        self._forget_freed_frames()
         if not suffix:
             suffix = name
-        df_id = id(df)
-        # print('df {} has id {}'.format(name, df_id))
-        if name in self._smart_frames:
+        df_handle = self._get_handle_if_known(df)
+        if df_handle is not None:
+            print('WHOA THIS DATAFRAME IS ALREADY SMART')
+            # it just gets known by the new name as well
+            self._handles_by_name[name] = df_handle
+            self._names_by_handle[df_handle] = name
+            if not derived:
+                self._smart_frames[name] = df
+            return
+        if name in self._handles_by_name:
             print('WARNING: Overwriting known smart frame!!!!!')
-            # TODO: fix up all references and/or disallow this
-        self._smart_frames[name] = make_df_smart(df, suffix)
-        self._names_of_dfs_known_to_be_smart[id(df)] = name
-        # print('Adding smart frame ' + name + ' with id ' + str(id(df)))
+            # the frame that was known by this name stays known by its handle
+            # for as long as something else still holds it.
+            # cached merges may have been made from the frame being replaced
+            self._merge_cache.discard_involving(name)
+            self._smart_frames.pop(name, None)
+            self._lazy_loaders.pop(self._handles_by_name[name], None)
+        df_handle = self._next_handle
+        self._next_handle += 1
+        # print('df {} has handle {}'.format(name, df_handle))
+        self._foreign_keys[df_handle] = dict()
+        make_df_smart(df, suffix, handle=df_handle, foreign_keys=self._foreign_keys[df_handle])
+        self._frames_by_handle[df_handle] = weakref.ref(df, self._make_freed_callback(df_handle))
+        self._handles_by_name[name] = df_handle
+        self._names_by_handle[df_handle] = name
+        if not derived:
+            self._smart_frames[name] = df
+            if self.value_index is not None:
+                self.value_index.add_frame(name, df)
+        # print('Adding smart frame ' + name + ' with handle ' + str(df_handle))
+
+    # loader is called with no arguments and returns the frame
+    def add_lazy(self, name, loader, suffix=None):
+        print('adding dataframe ' + name + ' (loaded when first used)')
+        if not suffix:
+            suffix = name
+        if name in self._handles_by_name:
+            print('WARNING: Overwriting known smart frame!!!!!')
+            self._merge_cache.discard_involving(name)
+            self._smart_frames.pop(name, None)
+            self._lazy_loaders.pop(self._handles_by_name[name], None)
+        df_handle = self._next_handle
+        self._next_handle += 1
+        self._foreign_keys[df_handle] = dict()
+        self._lazy_loaders[df_handle] = (loader, suffix)
+        self._handles_by_name[name] = df_handle
+        self._names_by_handle[df_handle] = name
+    def is_loaded(self, name):
+        return self._handles_by_name[name] not in self._lazy_loaders
+    # the loader of a frame that hasn't been loaded yet, otherwise None
+    def get_lazy_loader(self, name):
+        loader = self._lazy_loaders.get(self._handles_by_name[name])
+        if loader is None:
+            return None
+        return loader[0]
+    def _load(self, df_handle):
+        loader, suffix = self._lazy_loaders[df_handle]
+        name = self._names_by_handle[df_handle]
+        print('loading dataframe ' + name)
+        df = loader()
+        make_df_smart(df, suffix, handle=df_handle, foreign_keys=self._foreign_keys[df_handle])
+        self._frames_by_handle[df_handle] = weakref.ref(df, self._make_freed_callback(df_handle))
+        self._smart_frames[name] = df
+        if self.value_index is not None:
+            self.value_index.add_frame(name, df)
+        # only once it has loaded, so that a failed load can be tried again
+        del self._lazy_loaders[df_handle]
+        return df
+
+    # the value index of the base frames, which is built the first time it's
+    # asked for unless the merger was given one. frames that haven't been
+    # loaded yet aren't in it until they are.
+    def get_value_index(self):
+        if self.value_index is None:
+            self.value_index = value_index.ValueIndex()
+            for name, df in self._smart_frames.items():
+                self.value_index.add_frame(name, df)
+        return self.value_index
+
+    # the callback can run in the middle of anything (whenever the frame
+    # is collected), so it only notes the handle for _forget_freed_frames
+    def _make_freed_callback(self, df_handle):
+        freed_handles = self._freed_handles
+        def freed(ref):
+            freed_handles.append(df_handle)
+        return freed
+    def _forget_freed_frames(self):
+        while self._freed_handles:
+            self._forget(self._freed_handles.pop())
+    def _forget(self, df_handle):
+        name = self._names_by_handle.pop(df_handle, None)
+        if self._handles_by_name.get(name) == df_handle:
+            del self._handles_by_name[name]
+        self._frames_by_handle.pop(df_handle, None)
+        self._column_indexes.pop(df_handle, None)
+        # nothing can be merged into it anymore...
+        for holder in self._handles_which_have_a_foreign_key_for_this_handle.pop(df_handle, []):
+            self._foreign_keys.get(holder, {}).pop(df_handle, None)
+        # ...and it no longer knows how to merge into anything
+        for target in self._foreign_keys.pop(df_handle, {}):
+            holders = self._handles_which_have_a_foreign_key_for_this_handle.get(target, [])
+            if df_handle in holders:
+                holders.remove(df_handle)
+
+    def _get_frame_for_handle(self, df_handle):
+        if df_handle in self._lazy_loaders:
+            return self._load(df_handle)
+        ref = self._frames_by_handle.get(df_handle)
+        if ref is None:
+            return None
+        return ref()
+    # the handle of df if it is a frame this merger knows, otherwise None.
+    # frames derived from a smart frame carry a copy of its handle, so we
+    # make sure it is really the same frame.
+    def _get_handle_if_known(self, df):
+        try:
+            df_handle = handle(df)
+        except AttributeError:
+            return None
+        if df_handle is not None and self._get_frame_for_handle(df_handle) is df:
+            return df_handle
+        return None
+    def _get_handle(self, df_or_name):
+        df_handle = self._get_handle_if_known(df_or_name)
+        if df_handle is None:
+            df_handle = self._handles_by_name[df_or_name]
+        return df_handle
+
+    # the sorted column indexes of a known frame, which are built as they
+    # are used and go away along with the frame.
+    def get_column_index(self, df_or_name):
+        df_handle = self._get_handle(df_or_name)
+        if df_handle not in self._column_indexes:
+            self._column_indexes[df_handle] = column_index.ColumnIndexManager()
+        return self._column_indexes[df_handle]
+
     # this just gets a dataframe by name
     def __getitem__(self, name):
-        return self._smart_frames[name]
+        self._forget_freed_frames()
+        df = self._get_frame_for_handle(self._handles_by_name[name])
+        if df is None:
+            raise KeyError(name)
+        return df
     def __iter__(self):
-        return iter(self._smart_frames.keys())
+        return iter(self.get_known_names())
     def _convert_to_name(self, df_or_name):
         # if it isn't a name, it's a dataframe and can be reverse-lookuped
-        try:
-            return self._names_of_dfs_known_to_be_smart[id(df_or_name)]
-        except:
-            return df_or_name # it needs to already be a name if it's not a dataframe
+        df_handle = self._get_handle_if_known(df_or_name)
+        if df_handle is not None:
+            return self._names_by_handle[df_handle]
+        return df_or_name # it needs to already be a name if it's not a dataframe
     def _get_best_printable_name(self, df):
         # this might already be a name
         try:
@@ -74,8 +295,8 @@ class DataframeSmartMerger(object):
             return self.get_known_name(df)
         except:
             try:
-                # next guess is that it's an id
-                return self._names_of_dfs_known_to_be_smart[df]
+                # next guess is that it's a handle
+                return self._names_by_handle[df]
             except:
                 # last guess is that it is a dataframe that we don't know about
                 # print('couldnt return known name of id ' + str(id(df)))
@@ -84,32 +305,22 @@ class DataframeSmartMerger(object):
         # this might be a name, or it might be an actual dataframe
         df_name = self._convert_to_name(df)
         try:
-            return self._smart_frames[df_name]
-        except KeyError:
+            return self[df_name]
+        except (KeyError, TypeError):
             return None
     def _get_df_if_known_name(self, df):
         try:
-            return self._smart_frames[df]
+            return self[df]
         except:
             # hopefully this is already a dataframe
             return df
-    def _add_reverse_smart_merge(self, df_id, smart_frame):
-        df_name = self._get_best_printable_name(df_id)
-        if df_id not in self._smart_frames_which_have_a_foreign_key_for_this_dfid:
-            # print('creating reverse lookup smart frame list for ' + df_name)
-            self._smart_frames_which_have_a_foreign_key_for_this_dfid[df_id] = list()
+    def _add_reverse_smart_merge(self, df_handle, holder_handle):
         # print('noting that df {} is known (a foreign key is possessed) by smart frame {}'.format(
-        #     df_name,
-        #     self._get_best_printable_name(smart_frame.df)))
-        sf_list = self._smart_frames_which_have_a_foreign_key_for_this_dfid[df_id]
-        sf_id = id(smart_frame)
-        contains = False
-        for item in sf_list:
-            iid = id(item)
-            if iid == sf_id:
-                contains = True
-        if contains:
-            self._smart_frames_which_have_a_foreign_key_for_this_dfid[df_id].append(smart_frame)
+        #     self._get_best_printable_name(df_handle),
+        #     self._get_best_printable_name(holder_handle)))
+        holders = self._handles_which_have_a_foreign_key_for_this_handle.setdefault(df_handle, list())
+        if holder_handle not in holders:
+            holders.append(holder_handle)
         else:
             # it's possible that two dataframes which can both be merged
             # into the same other dataframe may get merged together.
@@ -131,9 +342,6 @@ class DataframeSmartMerger(object):
             # the columns have been renamed. If they have been renamed,
             # we could add a new foreign key record to all SmartFrames
             # with the new merged name. But for now we'll leave this as-is.
-
-            # print("WARNING - this smart frame {} has already been added for df {}".format(
-            #     self._get_best_printable_name(smart_frame), df_name))
             pass
 
     # Registering a smart merge means declaring that the first dataframe
@@ -146,21 +354,146 @@ class DataframeSmartMerger(object):
     # NB: These may be names or dataframes, but the first one at least must
     # be a known smart frame, or this will fail.
     def register_smart_merge(self, df, foreign_key, other_df):
-        smart_frame = self._get_smart_frame(df)
-        other_df = self._get_df_if_known_name(other_df) # if it's just a name but we already know about it
-        self._register_smart_merge(smart_frame, foreign_key, id(other_df))
+        self._forget_freed_frames()
+        holder_handle = self._get_handle(df)
+        other_handle = self._get_handle(other_df) # it may be just a name that we already know about
+        self._register_smart_merge(holder_handle, foreign_key, other_handle)
 
-    def _register_smart_merge(self, smart_frame, foreign_key, df_id):
-        # print('I declare that df ' + self._get_best_printable_name(smart_frame.df)
+    def _register_smart_merge(self, holder_handle, foreign_key, df_handle):
+        # print('I declare that df ' + self._get_best_printable_name(holder_handle)
         #       + ' has an attribute ' + foreign_key + ' that allows it to join to '
-        #       + self._get_best_printable_name(df_id) + '\'s primary key')
-        add_fkey_for_dfid(smart_frame, df_id, foreign_key)
-        self._add_reverse_smart_merge(df_id, smart_frame)
+        #       + self._get_best_printable_name(df_handle) + '\'s primary key')
+        self._foreign_keys[holder_handle][df_handle] = foreign_key
+        self._add_reverse_smart_merge(df_handle, holder_handle)
 
     def get_known_names(self):
-        return self._smart_frames.keys()
+        self._forget_freed_frames()
+        return list(self._handles_by_name.keys())
     def get_known_name(self, df):
-        return self._names_of_dfs_known_to_be_smart[id(df)]
+        df_handle = self._get_handle_if_known(df)
+        if df_handle is None:
+            raise KeyError('not a known dataframe')
+        return self._names_by_handle[df_handle]
+
+    # Plans a merge of several known frames at once, from the smart merges
+    # registered between them. Every registered merge joins a foreign key to
+    # a primary index, so the frames have to form a tree that hangs off a
+    # single root frame which none of the others has a foreign key for.
+    # The merged frame has one row per root row that matches in every join.
+    # Joins are ordered smallest target frame first, since those are the
+    # likeliest to drop rows early. Returns the root name and the list of
+    # (foreign key holder name, foreign key, target name) joins.
+    def plan_merge_chain(self, dfs_or_names):
+        names = list()
+        for df_or_name in dfs_or_names:
+            name = self._convert_to_name(df_or_name)
+            self[name] # die early on unknown names
+            if name not in names:
+                names.append(name)
+        edges = list()
+        for holder in names:
+            for target in names:
+                if holder != target and sf_has_target(self[holder], self[target]):
+                    edges.append((holder, get_fkey(self[holder], self[target]), target))
+        targets = set(edge[2] for edge in edges)
+        roots = [name for name in names if name not in targets]
+        if len(roots) != 1:
+            raise ValueError('cannot merge ' + ', '.join(names) + ' in a single pass')
+
+        joined = [roots[0]]
+        plan = list()
+        while len(joined) < len(names):
+            candidates = [edge for edge in edges
+                          if edge[0] in joined and edge[2] not in joined]
+            if not candidates:
+                raise ValueError('cannot merge ' + ', '.join(names) + ' in a single pass')
+            edge = min(candidates, key=lambda edge: len(self[edge[2]]))
+            plan.append(edge)
+            joined.append(edge[2])
+        return roots[0], plan
+
+    # The merge_chain of the root rows at root_positions (all of them if
+    # None) along plan. Returns the merged frame and, for each frame, the
+    # {original column: merged column} of its columns that were renamed.
+    def _merge_chain_rows(self, root, plan, root_positions=None):
+        if root_positions is None:
+            root_positions = np.arange(len(self[root]))
+        positions = {root: np.asarray(root_positions)}
+        for holder, foreign_key, target in plan:
+            if not self[target].index.is_unique:
+                raise ValueError(target + ' has a non-unique index')
+            keys = self[holder][foreign_key].values.take(positions[holder])
+            target_positions = self[target].index.get_indexer(keys)
+            found = target_positions >= 0
+            if not found.all():
+                for name in positions:
+                    positions[name] = positions[name][found]
+                target_positions = target_positions[found]
+            positions[target] = target_positions
+
+        merged_index = self[root].index.take(positions[root])
+        parts = list()
+        taken_columns = set()
+        renamed = dict() # name -> {original column: merged column}
+        for name in [root] + [edge[2] for edge in plan]:
+            part = self[name].take(positions[name])
+            part.index = merged_index
+            renamed[name] = dict()
+            for col in part.columns:
+                if col in taken_columns:
+                    renamed[name][col] = str(col) + suffix(self[name])
+            if renamed[name]:
+                part = part.rename(columns=renamed[name])
+            taken_columns.update(part.columns)
+            parts.append(part)
+        return pd.concat(parts, axis=1), renamed
+
+    # Like merge_chain, but only for the rows of the root frame at
+    # root_positions, and the result isn't kept or made smart. For working
+    # on a few new rows without merging everything again.
+    def merge_chain_rows(self, dfs_or_names, root_positions):
+        root, plan = self.plan_merge_chain(dfs_or_names)
+        return self._merge_chain_rows(root, plan, root_positions)[0]
+
+    # Merges several known frames following plan_merge_chain. The joins are
+    # worked out on row positions only, and each component frame's rows are
+    # taken once at the end, so no intermediate merged frames are built.
+    # Columns whose names are already taken get the suffix of the frame
+    # they came from, as in smart_merge.
+    def merge_chain(self, dfs_or_names):
+        root, plan = self.plan_merge_chain(dfs_or_names)
+        merged_name = '+'.join([root] + [edge[2] for edge in plan])
+        cache_key = (merged_name, '', None, 'chain')
+        merged = self._merge_cache.get(cache_key)
+        if merged is not None and self._get_df_if_known_name(merged_name) is merged:
+            return merged
+
+        with instrumentation.stage('merge_chain', domain=merged_name) as rec:
+            merged, renamed = self._merge_chain_rows(root, plan)
+            rec['rows'] = len(merged)
+            rec['bytes'] = frame_nbytes(merged)
+
+        self.add(merged, merged_name, derived=True)
+        merged_handle = handle(merged)
+        chain_names = [root] + [edge[2] for edge in plan]
+        chain_handles = set(self._handles_by_name[name] for name in chain_names)
+        # the merged frame can still be merged with any frame outside the chain
+        # that one of its components had a foreign key for
+        for name in chain_names:
+            for target_handle, fkey in list(fkeys(self[name]).items()):
+                if target_handle not in chain_handles:
+                    self._register_smart_merge(merged_handle,
+                                               renamed[name].get(fkey, fkey), target_handle)
+        # and since it has the root's index, anything that could be merged
+        # into the root can be merged into it
+        root_handle = self._handles_by_name[root]
+        for holder in list(self._handles_which_have_a_foreign_key_for_this_handle.get(root_handle, [])):
+            if holder not in chain_handles:
+                self._register_smart_merge(holder, self._foreign_keys[holder][root_handle],
+                                           merged_handle)
+
+        self._merge_cache.put(cache_key, merged)
+        return merged
 
     # As long as one of these is a dataframe or dataframe name that is known
     # by the DataFrameBrowser, and as long as that smart frame has a
@@ -179,6 +512,8 @@ class DataframeSmartMerger(object):
         if preferred_df_to_suffix is None or (id(preferred_df_to_suffix) != id(df1) and
                                               id(preferred_df_to_suffix) != id(df2)):
             preferred_df_to_suffix = df2
+        # it may be a known name, but it gets compared to the merged frames below
+        preferred_df_to_suffix = self._get_df_if_known_name(preferred_df_to_suffix)
 
         smart_frame_1 = self._get_smart_frame(df1)
         smart_frame_2 = self._get_smart_frame(df2)
@@ -207,6 +542,7 @@ class DataframeSmartMerger(object):
             df2 = smart_frame_2
 
         # we give preference to the first smart frame, if there are two
+        smart_frame_w_primkey = None
         if sf_has_target(smart_frame_1, df2):
             smart_frame_w_fkey = smart_frame_1
             df_w_primkey = df2
@@ -248,67 +584,76 @@ class DataframeSmartMerger(object):
         #     df_w_fkey_name, df_w_primkey_name, foreign_key))
 
         if id(preferred_df_to_suffix) == id(smart_frame_w_fkey):
-            merged = smart_frame_w_fkey.merge(df_w_primkey,
-                                              left_on=foreign_key, right_index=True,
-                                              suffixes=(suffix(smart_frame_w_fkey), ''))
+            suffixed = 'fkey'
         elif id(preferred_df_to_suffix) == id(df_w_primkey) and is_smart_frame(df_w_primkey):
-            merged = smart_frame_w_fkey.merge(df_w_primkey,
-                                              left_on=foreign_key, right_index=True,
-                                              suffixes=('', suffix(df_w_primkey)))
+            suffixed = 'primkey'
         else:
-            merged = smart_frame_w_fkey.merge(df_w_primkey,
-                                              left_on=foreign_key, right_index=True,
-                                              suffixes=(suffix(smart_frame_w_fkey),
-                                                        suffix(df_w_primkey)))
+            suffixed = 'both'
+        merged_name = df_w_fkey_name + '+' + df_w_primkey_name
+        # a repeated merge of the same two known frames returns the earlier result,
+        # as long as that is still the frame known by the merged name
+        cache_key = None
+        if (df_w_fkey_name in self._handles_by_name and
+            df_w_primkey_name in self._handles_by_name):
+            cache_key = (df_w_fkey_name, df_w_primkey_name, foreign_key, suffixed)
+            merged = self._merge_cache.get(cache_key)
+            if merged is not None and self._get_df_if_known_name(merged_name) is merged:
+                return merged
+
+        with instrumentation.stage('smart_merge', domain=merged_name) as rec:
+            if suffixed == 'fkey':
+                merged = smart_frame_w_fkey.merge(df_w_primkey,
+                                                  left_on=foreign_key, right_index=True,
+                                                  suffixes=(suffix(smart_frame_w_fkey), ''))
+            elif suffixed == 'primkey':
+                merged = smart_frame_w_fkey.merge(df_w_primkey,
+                                                  left_on=foreign_key, right_index=True,
+                                                  suffixes=('', suffix(df_w_primkey)))
+            else:
+                merged = smart_frame_w_fkey.merge(df_w_primkey,
+                                                  left_on=foreign_key, right_index=True,
+                                                  suffixes=(suffix(smart_frame_w_fkey),
+                                                            suffix(df_w_primkey)))
+            # pandas gives the key column the dtype of the index it was joined
+            # to, so a categorical key (see sdb_utils.compact_dtypes) is put back
+            key_dtype = smart_frame_w_fkey[foreign_key].dtype
+            if (isinstance(key_dtype, pd.CategoricalDtype) and foreign_key in merged and
+                merged[foreign_key].dtype != key_dtype):
+                merged[foreign_key] = merged[foreign_key].astype(key_dtype)
+            rec['rows'] = len(merged)
+            rec['bytes'] = frame_nbytes(merged)
 
         # now we need to do bookkeeping and record any new known smart merges
         # add the new merged dataframe as a smart frame, since it's based on at least one smart frame
-        merged_name = df_w_fkey_name + '+' + df_w_primkey_name
-        self.add(merged, merged_name)
-        merged_smart_frame = self._get_smart_frame(merged_name)
+        self.add(merged, merged_name, derived=True)
+        merged_handle = handle(merged)
 
         # print('add available foreign keys of foreign_key df to merged df smart frame')
         # add available foreign keys of component dfs to merged df
-        for df_id in fkeys(smart_frame_w_fkey).keys():
-            fkey = fkeys(smart_frame_w_fkey)[df_id]
+        for target_handle, fkey in list(fkeys(smart_frame_w_fkey).items()):
             if fkey == foreign_key:
                 continue # we just merged on this, so it can't be merged on for the new df
-            self._register_smart_merge(merged_smart_frame, fkey, df_id)
+            self._register_smart_merge(merged_handle, fkey, target_handle)
         # print('add available foreign keys of primary key df to merged df')
         if smart_frame_w_primkey is not None:
-            for df_id in fkeys(smart_frame_w_primkey).keys():
-                fkey = fkeys(smart_frame_w_primkey)[df_id]
+            for target_handle, fkey in list(fkeys(smart_frame_w_primkey).items()):
                 # we shouldn't have reuse in here, because we didn't use these
-                self._register_smart_merge(merged_smart_frame, fkey, df_id)
-        # now add available foreign keys of  smart frames
-        # that know how to merge into the component dfs
-        merged_id = id(merged)
-        df_primkey_id = id(df_w_primkey)
-        # print('STEP TWO {}'.format(df_primkey_id))
-        # print('add available foreign keys of smart frames that know how to merge into the primkey df')
-        if df_primkey_id in self._smart_frames_which_have_a_foreign_key_for_this_dfid:
-            smart_frames_which_know_this_df_id = self._smart_frames_which_have_a_foreign_key_for_this_dfid[df_primkey_id]
-            for smart_frame in smart_frames_which_know_this_df_id:
-                the_fkey = get_fkey_for_dfid(smart_frame, df_primkey_id)
-                if the_fkey == foreign_key:
-                    # print('skipping fkey {} possessed by {} because it disappeared in this merge'.format(
-                    #     the_fkey, self._get_best_printable_name(smart_frame)))
-                    continue
-                self._register_smart_merge(smart_frame,
-                                           the_fkey,
-                                           merged_id)
-        df_fkey_id = id(smart_frame_w_fkey)
+                self._register_smart_merge(merged_handle, fkey, target_handle)
+        # now add available foreign keys of smart frames
+        # that know how to merge into the foreign key df. the merged df keeps
+        # its index, so they can merge into the merged df the same way.
+        # (the primary key df's index is gone after the merge, so smart frames
+        # that know how to merge into that one can't merge into the merged df.)
+        df_fkey_handle = handle(smart_frame_w_fkey)
         # print('add available foreign keys of smart frames that know how to merge into the foreignkey df')
-        if df_fkey_id in self._smart_frames_which_have_a_foreign_key_for_this_dfid:
-            smart_frames_which_know_this_df_id = self._smart_frames_which_have_a_foreign_key_for_this_dfid[df_fkey_id]
-            for smart_frame in smart_frames_which_know_this_df_id:
-                the_fkey = get_fkey_for_dfid(smart_frame, df_fkey_id)
-                if the_fkey == foreign_key:
-                    # print('skipping fkey {} possessed by {} because it disappeared in this merge'.format(
-                    #     the_fkey, self._get_best_printable_name(smart_frame)))
-                    continue
-                self._register_smart_merge(smart_frame,
-                                           the_fkey,
-                                           merged_id)
+        for holder in list(self._handles_which_have_a_foreign_key_for_this_handle.get(df_fkey_handle, [])):
+            the_fkey = self._foreign_keys[holder][df_fkey_handle]
+            if the_fkey == foreign_key:
+                # print('skipping fkey {} possessed by {} because it disappeared in this merge'.format(
+                #     the_fkey, self._get_best_printable_name(holder)))
+                continue
+            self._register_smart_merge(holder, the_fkey, merged_handle)
 
+        if cache_key is not None:
+            self._merge_cache.put(cache_key, merged)
         return merged
@@ -0,0 +1,57 @@
+# The interactive scripts need pandas, numpy and boto (through dubois),
+# which take a second or more to import. Warmup does that, and anything
+# else slow like opening the SDB connection, in a background thread, so a
+# script can show its first prompt right away and get the slow part done
+# while the user is typing.
+#
+# This module only imports the standard library, so that importing it
+# costs nothing.
+import os
+import time
+import threading
+
+# when this module was first imported, which the scripts do first thing
+started = time.time()
+
+class Warmup:
+    def __init__(self, func):
+        self._func = func
+        self._result = None
+        self._error = None
+        self.seconds = None
+        # a daemon, so that quitting at the first prompt doesn't wait for it
+        self._thread = threading.Thread(target=self._run, name='warmup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        start = time.time()
+        try:
+            self._result = self._func()
+        except Exception as e:
+            self._error = e
+        self.seconds = time.time() - start
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    # waits for the warm-up to finish, and returns what func returned (or
+    # raises what it raised)
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+# whether there's a local copy of downloaded data to offer. until the
+# warm-up has finished this only checks that the directory is there, so
+# that the first prompt doesn't wait for dubois to be imported.
+def may_have_local_data(warm, lcl_dir='local_data'):
+    if warm is not None and not warm.done():
+        return os.path.isdir(lcl_dir)
+    import dubois
+    return dubois.has_local_domain_data(lcl_dir=lcl_dir)
+
+# seconds from startup until now, for reporting how long the prompt took
+def seconds_since_start():
+    return time.time() - started
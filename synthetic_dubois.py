@@ -0,0 +1,237 @@
+# Synthetic Dubois domains for benchmarking without AWS.
+# Rows are generated from their row number alone, so any item of any domain
+# can be produced on demand, and the foreign keys line up the same way
+# they do in the real data (see dubois._known_merges).
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+# rows per game, for the domains that scale with the number of games
+ANSWERS_PER_GAME = 30
+CHALLENGES_PER_GAME = 10
+GAMES_PER_MATHLETE = 20
+MATHLETES_PER_DEVICE = 2
+MATHLETES_PER_COACH = 25
+ATTRIBUTE_UPDATES_PER_MATHLETE = 2
+DEVICES_PER_EXCEPTION = 5
+NUM_REPRESENTATIONS = 40
+
+GAME_TYPES = ['fractions', 'matching', 'number_line', 'speed']
+REPR_TYPES = ['pie', 'bar', 'numeral', 'set']
+POOLS = ['A', 'B', 'C']
+
+# number of rows in each domain, keyed by shortname
+def domain_sizes(num_answers):
+    num_games = max(1, num_answers // ANSWERS_PER_GAME)
+    num_mathletes = max(1, num_games // GAMES_PER_MATHLETE)
+    num_devices = max(1, num_mathletes // MATHLETES_PER_DEVICE)
+    return {
+        'answers': num_answers,
+        'challenges': max(1, num_games * CHALLENGES_PER_GAME),
+        'games': num_games,
+        'mathletes': num_mathletes,
+        'devices': num_devices,
+        'coaches': max(1, num_mathletes // MATHLETES_PER_COACH),
+        'attributes': num_mathletes * ATTRIBUTE_UPDATES_PER_MATHLETE,
+        'representations': NUM_REPRESENTATIONS,
+        'exceptions': max(1, num_devices // DEVICES_PER_EXCEPTION),
+    }
+
+def item_name(shortname, i):
+    return shortname + '-' + str(i)
+
+# cheap, deterministic stand-in for randomness
+def _scramble(i, modulus):
+    return (i * 2654435761 + 12345) % modulus
+
+# maps row i of a domain with n rows onto one of m rows of another domain
+def _spread(i, n, m):
+    return i * m // n
+
+def _datetime_at(i, n, date_start, date_end):
+    return (date_start + (date_end - date_start) * (i + 0.5) / n).replace(microsecond=0).isoformat()
+
+# Returns a function of the row number that returns (itemName, attributes)
+# for one domain. Datetimes increase with the row number and are spread
+# evenly over [date_start, date_end).
+def make_item_function(shortname, sizes, date_start, date_end):
+    n = sizes[shortname]
+    def when(i):
+        return _datetime_at(i, n, date_start, date_end)
+
+    def answer(i):
+        challenge = _spread(i, n, sizes['challenges'])
+        game = _spread(challenge, sizes['challenges'], sizes['games'])
+        return {
+            'challenge_id': item_name('challenges', challenge),
+            'game_id': item_name('games', game),
+            'datetime': when(i),
+            'answer': '{}/{}'.format(_scramble(i, 9) + 1, 10),
+            'correct': '1' if _scramble(i, 4) else '0',
+            'time_elapsed': str(_scramble(i, 3000) / 100.0),
+        }
+    def challenge(i):
+        return {
+            'game_id': item_name('games', _spread(i, n, sizes['games'])),
+            'repr_id': item_name('representations', _scramble(i, sizes['representations'])),
+            'datetime': when(i),
+            'level': str(_scramble(i, 12)),
+            'value': '{}/{}'.format(_scramble(i, 7) + 1, 8),
+            'solution': '{}/{}'.format(_scramble(i, 7) + 1, 8),
+            'pool': POOLS[_scramble(i, len(POOLS))],
+        }
+    def game(i):
+        mathlete = _spread(i, n, sizes['mathletes'])
+        return {
+            'player_id': item_name('mathletes', mathlete),
+            'admin_key': item_name('coaches', _scramble(mathlete, sizes['coaches'])),
+            'device_id': item_name('devices', _spread(mathlete, sizes['mathletes'], sizes['devices'])),
+            'start': when(i),
+            'end': when(i),
+            'game_type': GAME_TYPES[_scramble(i, len(GAME_TYPES))],
+            'level_at_end': str(_scramble(i, 12)),
+            'score': str(_scramble(i, 1000)),
+            'num_solved': str(_scramble(i, CHALLENGES_PER_GAME + 1)),
+        }
+    def mathlete(i):
+        return {'name': 'mathlete ' + str(i)}
+    def coach(i):
+        return {'name': 'coach ' + str(i)}
+    def device(i):
+        return {
+            'datetime_last_launched': when(i),
+            'datetime_first_install': when(i),
+        }
+    def attribute(i):
+        return {
+            'mathlete_id': item_name('mathletes', _spread(i, n, sizes['mathletes'])),
+            'datetime': when(i),
+            'level_integer': str(_scramble(i, 12)),
+            'level_fraction': str(_scramble(i, 100) / 100.0),
+        }
+    def representation(i):
+        return {
+            'repr_type': REPR_TYPES[i % len(REPR_TYPES)],
+            'repr_level': str(i // len(REPR_TYPES)),
+            'repr_descrip': 'representation ' + str(i),
+        }
+    def exception(i):
+        return {
+            'device_id': item_name('devices', _spread(i, n, sizes['devices'])),
+            'datetime': when(i),
+            'notes': 'Traceback ' + str(_scramble(i, 50)),
+        }
+
+    make_attrs = {
+        'answers': answer,
+        'challenges': challenge,
+        'games': game,
+        'mathletes': mathlete,
+        'coaches': coach,
+        'devices': device,
+        'attributes': attribute,
+        'representations': representation,
+        'exceptions': exception,
+    }[shortname]
+    def make_item(i):
+        return item_name(shortname, i), make_attrs(i)
+    return make_item
+
+# The same rows as make_item_function makes one at a time, but built
+# column by column for a whole domain at once, as a frame of strings like
+# the ones SDB returns, indexed by itemName. This is what makes frames of
+# millions of rows practical. (Datetimes may differ from the one-at-a-time
+# ones by a second, from rounding.)
+def make_domain_frame(shortname, sizes, date_start, date_end):
+    n = sizes[shortname]
+    i = np.arange(n, dtype=np.int64)
+    def names(of, rows):
+        return of + '-' + pd.Series(rows).astype(str).values
+    def text(values):
+        return pd.Series(values).astype(str).values
+    def when(rows):
+        span = pd.Timestamp(date_end) - pd.Timestamp(date_start)
+        offsets = pd.to_timedelta(span.value * (rows + 0.5) / n, unit='ns')
+        stamps = (pd.Timestamp(date_start) + offsets).values.astype('datetime64[s]')
+        return np.datetime_as_string(stamps).astype(object)
+    def fraction(numerators, denominator):
+        return text(numerators) + '/' + str(denominator)
+    def choose(choices, rows):
+        return np.array(choices, dtype=object)[rows]
+
+    if shortname == 'answers':
+        challenge = _spread(i, n, sizes['challenges'])
+        columns = {
+            'challenge_id': names('challenges', challenge),
+            'game_id': names('games', _spread(challenge, sizes['challenges'], sizes['games'])),
+            'datetime': when(i),
+            'answer': fraction(_scramble(i, 9) + 1, 10),
+            'correct': np.where(_scramble(i, 4) > 0, '1', '0'),
+            'time_elapsed': text(_scramble(i, 3000) / 100.0),
+        }
+    elif shortname == 'challenges':
+        columns = {
+            'game_id': names('games', _spread(i, n, sizes['games'])),
+            'repr_id': names('representations', _scramble(i, sizes['representations'])),
+            'datetime': when(i),
+            'level': text(_scramble(i, 12)),
+            'value': fraction(_scramble(i, 7) + 1, 8),
+            'solution': fraction(_scramble(i, 7) + 1, 8),
+            'pool': choose(POOLS, _scramble(i, len(POOLS))),
+        }
+    elif shortname == 'games':
+        mathlete = _spread(i, n, sizes['mathletes'])
+        columns = {
+            'player_id': names('mathletes', mathlete),
+            'admin_key': names('coaches', _scramble(mathlete, sizes['coaches'])),
+            'device_id': names('devices', _spread(mathlete, sizes['mathletes'], sizes['devices'])),
+            'start': when(i),
+            'end': when(i),
+            'game_type': choose(GAME_TYPES, _scramble(i, len(GAME_TYPES))),
+            'level_at_end': text(_scramble(i, 12)),
+            'score': text(_scramble(i, 1000)),
+            'num_solved': text(_scramble(i, CHALLENGES_PER_GAME + 1)),
+        }
+    elif shortname == 'mathletes':
+        columns = {'name': 'mathlete ' + text(i)}
+    elif shortname == 'coaches':
+        columns = {'name': 'coach ' + text(i)}
+    elif shortname == 'devices':
+        columns = {
+            'datetime_last_launched': when(i),
+            'datetime_first_install': when(i),
+        }
+    elif shortname == 'attributes':
+        columns = {
+            'mathlete_id': names('mathletes', _spread(i, n, sizes['mathletes'])),
+            'datetime': when(i),
+            'level_integer': text(_scramble(i, 12)),
+            'level_fraction': text(_scramble(i, 100) / 100.0),
+        }
+    elif shortname == 'representations':
+        columns = {
+            'repr_type': choose(REPR_TYPES, i % len(REPR_TYPES)),
+            'repr_level': text(i // len(REPR_TYPES)),
+            'repr_descrip': 'representation ' + text(i),
+        }
+    else:
+        columns = {
+            'device_id': names('devices', _spread(i, n, sizes['devices'])),
+            'datetime': when(i),
+            'notes': 'Traceback ' + text(_scramble(i, 50)),
+        }
+    return pd.DataFrame(columns, index=pd.Index(names(shortname, i), name='itemName'))
+
+# the default window that synthetic datetimes are spread over
+def default_window(days=30):
+    date_end = dt.datetime.combine(dt.date.today(), dt.time.min)
+    return date_end - dt.timedelta(days), date_end
+
+# adds a synthetic copy of every domain in ddomains (DuboisDomains)
+# to a sdb_standin.StandinConnection
+def install_standin_domains(conn, ddomains, num_answers, date_start, date_end):
+    sizes = domain_sizes(num_answers)
+    for dd in ddomains:
+        conn.add_domain(dd.name, sizes[dd.shortname],
+                        make_item_function(dd.shortname, sizes, date_start, date_end))
+    return sizes
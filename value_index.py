@@ -0,0 +1,108 @@
+# An inverted index over the string values of a set of frames, for
+# finding every place an ID or a string turns up (a device ID, an admin
+# key, an error message) without scanning every frame.
+#
+# For each string column (and the itemName index) of each frame, rows are
+# grouped by value once, so looking a value up is a hash lookup per column
+# that returns the row positions holding it. Values with spaces in them,
+# like exception notes, are also indexed by their words (ignoring case),
+# so that they can be found by any one word.
+import re
+import weakref
+import numpy as np
+import pandas as pd
+
+_word_re = re.compile(r'\S+')
+
+def _is_string_column(series):
+    return (isinstance(series.dtype, pd.CategoricalDtype) or
+            pd.api.types.is_object_dtype(series.dtype) or
+            pd.api.types.is_string_dtype(series.dtype))
+
+class _ColumnPostings:
+    def __init__(self, values):
+        codes, uniques = pd.factorize(values)
+        # rows sorted by value code, so each value's rows are one slice of
+        # order. missing values (code -1) sort first and are skipped.
+        self.order = np.argsort(codes, kind='stable')
+        num_missing = int((codes < 0).sum())
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]) + num_missing
+        self.values = pd.Index(uniques)
+        self.words = dict() # lowercased word -> codes of the values containing it
+        as_text = pd.Series(np.asarray(uniques, dtype=object)).astype(str)
+        for code in np.flatnonzero(as_text.str.contains(' ', regex=False).values):
+            for word in set(_word_re.findall(as_text.iloc[code].lower())):
+                self.words.setdefault(word, list()).append(code)
+
+    def _positions_of_code(self, code):
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    def positions_of_value(self, value):
+        try:
+            code = self.values.get_loc(value)
+        except (KeyError, TypeError):
+            return None
+        return self._positions_of_code(code)
+
+    def positions_of_word(self, word):
+        codes = self.words.get(word.lower())
+        if not codes:
+            return None
+        return np.sort(np.concatenate([self._positions_of_code(code) for code in codes]))
+
+class ValueIndex:
+    def __init__(self):
+        self._postings = dict() # frame name -> {column: _ColumnPostings}
+        self._frames = dict() # frame name -> weakref to the frame that was indexed
+
+    # indexes (or re-indexes) a frame under name. a frame that is already
+    # indexed under that name is left alone, so refreshing only costs
+    # something for the frames that actually changed.
+    def add_frame(self, name, df):
+        indexed = self._frames.get(name)
+        if indexed is not None and indexed() is df:
+            return
+        postings = dict()
+        index_name = df.index.name or 'itemName'
+        postings[index_name] = _ColumnPostings(df.index)
+        for col in df.columns:
+            if not _is_string_column(df[col]):
+                continue
+            try:
+                postings[col] = _ColumnPostings(df[col])
+            except TypeError:
+                # multi-valued attributes come back as lists, which can't be hashed
+                continue
+        self._postings[name] = postings
+        self._frames[name] = weakref.ref(df)
+
+    def remove_frame(self, name):
+        self._postings.pop(name, None)
+        self._frames.pop(name, None)
+
+    def frame_names(self):
+        return list(self._postings.keys())
+
+    # [(frame name, column, row positions)] for every column holding value
+    def lookup(self, value):
+        hits = list()
+        for name, postings in self._postings.items():
+            for col, column_postings in postings.items():
+                positions = column_postings.positions_of_value(value)
+                if positions is not None and len(positions):
+                    hits.append((name, col, positions))
+        return hits
+
+    # like lookup, but a column also counts as holding text if text is one
+    # of the words of its values
+    def find(self, text):
+        hits = list()
+        for name, postings in self._postings.items():
+            for col, column_postings in postings.items():
+                found = [positions for positions in (column_postings.positions_of_value(text),
+                                                     column_postings.positions_of_word(text))
+                         if positions is not None and len(positions)]
+                if found:
+                    hits.append((name, col, np.union1d(found[0], found[-1])))
+        return hits